@@ -1,14 +1,40 @@
 #!/usr/bin/env python3
 # coding: utf-8
 
+import codecs
+import enum
 import json
+import os
 import re
+import struct
+import uuid
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
 
 
 class Typehandler:
     def __init__(self):
         self._encoders = {}
         self._decoders = {}
+        # type: name of its encoder
+        self._types = {}
+        # type: (name, func) of the encoder found by its mro, or None
+        self._cache = {}
+        # bases: whether a type with an encoder is a subclass of them
+        self._subclasses = {}
 
     @property
     def encoders(self):
@@ -20,6 +46,34 @@ class Typehandler:
 
     def register_enc(self, tp, name, func):
         self._encoders[name] = {"type": tp, "func": func}
+        self._types[tp] = name
+        self._cache.clear()
+        self._subclasses.clear()
+
+    def encoder_of(self, tp):
+        """(name, func) of the encoder of the type, or of its nearest base class
+        with an encoder, None if there is no such one"""
+        try:
+            return self._cache[tp]
+        except KeyError:
+            pass
+        found = None
+        for base in tp.__mro__:
+            name = self._types.get(base)
+            if name is not None:
+                found = (name, self._encoders[name]["func"])
+                break
+        self._cache[tp] = found
+        return found
+
+    def encodes_subclass_of(self, bases):
+        "whether a type with an encoder is a subclass of the tuple of bases"
+        try:
+            return self._subclasses[bases]
+        except KeyError:
+            pass
+        found = self._subclasses[bases] = any(issubclass(tp, bases) for tp in self._types)
+        return found
 
     def register_dec(self, tp, name, func):
         self._decoders[name] = {"type": tp, "func": func}
@@ -37,60 +91,689 @@ def register_dec(tp, name, func):
 
 import datetime
 
-register_enc(datetime.datetime, "datetime", lambda x: x.strftime("%Y-%m-%d %H:%M:%S:%f"))
-register_dec(datetime.datetime, "datetime", lambda x: datetime.datetime.strptime(x, "%Y-%m-%d %H:%M:%S:%f"))
+# the text of strftime("%Y-%m-%d %H:%M:%S:%f"), without its cost
+def _enc_datetime(x):
+    return "%04d-%02d-%02d %02d:%02d:%02d:%06d" % (
+        x.year, x.month, x.day, x.hour, x.minute, x.second, x.microsecond)
+
+def _dec_datetime(x):
+    if len(x) == 26 and x[19] == ":":
+        return datetime.datetime.fromisoformat(x[:19] + "." + x[20:])
+    return datetime.datetime.strptime(x, "%Y-%m-%d %H:%M:%S:%f")
 
-register_enc(datetime.date, "date", lambda x: x.strftime("%Y-%m-%d"))
-register_dec(datetime.date, "date", lambda x: datetime.datetime.strptime(x, "%Y-%m-%d").date())
+def _enc_date(x):
+    return "%04d-%02d-%02d" % (x.year, x.month, x.day)
+
+def _dec_date(x):
+    if len(x) == 10:
+        return datetime.date.fromisoformat(x)
+    return datetime.datetime.strptime(x, "%Y-%m-%d").date()
+
+register_enc(datetime.datetime, "datetime", _enc_datetime)
+register_dec(datetime.datetime, "datetime", _dec_datetime)
+
+register_enc(datetime.date, "date", _enc_date)
+register_dec(datetime.date, "date", _dec_date)
 
 
 class CCJSONEncoder(json.JSONEncoder):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
-        self._encoders = _type_handler.encoders
+        self._encoder_of = _type_handler.encoder_of
 
     def default(self, obj):
-        try:
-            return super().default(self, obj)
-        except TypeError:
-            pass
-
-        for name in self._encoders:
-            tp = self._encoders[name]["type"]
-            if type(obj) == tp:
-                enc = self._encoders[name]["func"]
-                data = enc(obj)
-                return "#{}:{}".format(name, data)
-
-        raise TypeError(repr(obj) + " is not JSON serializable")
+        found = self._encoder_of(type(obj))
+        if found is None:
+            return super().default(obj)
+        name, enc = found
+        return "#" + name + ":" + str(enc(obj))
 
 
 class CCJSONDecoder(json.JSONDecoder):
+    """type markers are decoded while parsing, values of an object when it's
+    built, items of arrays in place, only strings starting with # are matched"""
+
     def __init__(self, **kwargs):
-        super().__init__(**kwargs)
+        self._object_hook = kwargs.pop("object_hook", None)
+        self._object_pairs_hook = kwargs.pop("object_pairs_hook", None)
+        super().__init__(object_pairs_hook=self._trans_pairs, **kwargs)
         self._decoders = _type_handler.decoders
         self._typemarker = re.compile("^#[^:]+:")
 
     def decode(self, ss, **kwargs):
         js = super().decode(ss, **kwargs)
+        # objects are done, but not the arrays and strings out of any object
         return self._trans_type(js)
 
+    def _trans_pairs(self, pairs):
+        trans = self._trans_type
+        if self._object_pairs_hook:
+            return self._object_pairs_hook([(k, trans(v)) for k, v in pairs])
+        obj = {k: trans(v) for k, v in pairs}
+        if self._object_hook:
+            return self._object_hook(obj)
+        return obj
+
     def _trans_type(self, obj):
-        if isinstance(obj, dict):
-            return {o: self._trans_type(obj[o]) for o in obj}
-        elif isinstance(obj, list):
-            return [self._trans_type(o) for o in obj]
-        elif isinstance(obj, str):
-            m = self._typemarker.match(obj)
-            if m:
-                x = m.end()
-                name = obj[1: x - 1]
-                data = obj[x:]
-                dec = self._decoders.get(name)
-                if dec:
-                    return  dec["func"](data)
+        tp = type(obj)
+        if tp is str:
+            if obj.startswith("#"):
+                return self._trans_str(obj)
+        elif tp is list:
+            self._trans_list(obj)
+        return obj
+
+    def _trans_list(self, lst):
+        for i, o in enumerate(lst):
+            tp = type(o)
+            if tp is str:
+                if o.startswith("#"):
+                    lst[i] = self._trans_str(o)
+            elif tp is list:
+                self._trans_list(o)
+
+    def _trans_tree(self, obj):
+        "convert in place a tree parsed without the hooks"
+        tp = type(obj)
+        if tp is dict:
+            for k, v in obj.items():
+                t = type(v)
+                if t is str:
+                    if v.startswith("#"):
+                        obj[k] = self._trans_str(v)
+                elif t is dict or t is list:
+                    self._trans_tree(v)
+        elif tp is list:
+            for i, o in enumerate(obj):
+                t = type(o)
+                if t is str:
+                    if o.startswith("#"):
+                        obj[i] = self._trans_str(o)
+                elif t is dict or t is list:
+                    self._trans_tree(o)
+        elif tp is str and obj.startswith("#"):
+            return self._trans_str(obj)
+        return obj
+
+    def _trans_str(self, obj):
+        m = self._typemarker.match(obj)
+        if m:
+            x = m.end()
+            name = obj[1: x - 1]
+            data = obj[x:]
+            dec = self._decoders.get(name)
+            if dec:
+                return dec["func"](data)
+        return obj
+
 
+def dump_array(iterable, fp, **kwargs):
+    """write the objects of an iterable as a json array into a text file,
+    one object is encoded at a time, kwargs go to CCJSONEncoder"""
+    enc = CCJSONEncoder(**kwargs)
+    sep = enc.item_separator
+    if enc.indent is not None:
+        sep = sep.rstrip() + "\n"
+    fp.write("[")
+    for i, obj in enumerate(iterable):
+        if i:
+            fp.write(sep)
+        fp.write(enc.encode(obj))
+    fp.write("]")
+
+
+def dump_lines(iterable, fp, **kwargs):
+    "write the objects of an iterable as json lines into a text file"
+    kwargs.pop("indent", None)
+    enc = CCJSONEncoder(**kwargs)
+    for obj in iterable:
+        fp.write(enc.encode(obj))
+        fp.write("\n")
+
+
+_WHITESPACE = " \t\n\r"
+
+def iter_array(fp, chunk_size=64 * 1024, **kwargs):
+    """yield the elements of a json array in a file, text or utf-8 bytes,
+    reading `chunk_size` at a time, kwargs go to CCJSONDecoder"""
+    dec = CCJSONDecoder(**kwargs)
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    buf = ""
+    pos = 0
+    eof = False
+
+    def more(size):
+        nonlocal buf, pos, eof
+        data = fp.read(size)
+        if isinstance(data, bytes):
+            data = utf8.decode(data, final=not data)
+        if not data:
+            eof = True
+        buf = buf[pos:] + data
+        pos = 0
+
+    def skip():
+        "skip whitespace, return the next char, or '' at eof"
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos] in _WHITESPACE:
+                pos += 1
+            if pos < len(buf):
+                return buf[pos]
+            if eof:
+                return ""
+            more(chunk_size)
+
+    if skip() != "[":
+        raise json.JSONDecodeError("Expecting '['", buf, pos)
+    pos += 1
+    if skip() == "]":
+        return
+    while True:
+        skip()
+        while True:
+            try:
+                obj, end = dec.raw_decode(buf, pos)
+                if eof:
+                    break
+                # a number may go on in the next chunk, as 123. and 45,
+                # so the element must be followed by a buffered , or ]
+                i = end
+                while i < len(buf) and buf[i] in _WHITESPACE:
+                    i += 1
+                if i < len(buf) and buf[i] in ",]":
+                    break
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            # read no less than what's buffered, so a huge element takes few tries
+            more(max(chunk_size, len(buf) - pos))
+        pos = end
+        yield dec._trans_type(obj)
+        c = skip()
+        pos += 1
+        if c == "]":
+            return
+        if c != ",":
+            raise json.JSONDecodeError("Expecting ',' delimiter", buf, pos - 1)
+
+
+def iter_lines(fp, **kwargs):
+    "yield the objects of json lines in a file, text or utf-8 bytes, blank lines are skipped"
+    dec = CCJSONDecoder(**kwargs)
+    for line in fp:
+        if isinstance(line, bytes):
+            line = line.decode("utf-8")
+        line = line.strip()
+        if line:
+            yield dec.decode(line)
+
+
+def _default(obj):
+    "the registered encoder for a fast backend"
+    found = _type_handler.encoder_of(type(obj))
+    if found is None:
+        raise TypeError("Object of type {} is not JSON serializable".format(type(obj).__name__))
+    name, enc = found
+    return "#" + name + ":" + str(enc(obj))
+
+
+def _json_dumps(obj, **kwargs):
+    return json.dumps(obj, cls=CCJSONEncoder, **kwargs)
+
+
+def _json_loads(s, **kwargs):
+    return json.loads(s, cls=CCJSONDecoder, **kwargs)
+
+
+# orjson writes these itself, json calls their registered encoders
+_ORJSON_NATIVE = (enum.Enum, uuid.UUID)
+
+
+def _orjson_dumps(obj, **kwargs):
+    indent = kwargs.get("indent")
+    if (set(kwargs) - {"indent", "sort_keys"} or indent not in (None, 2)
+            or _type_handler.encodes_subclass_of(_ORJSON_NATIVE)):
+        return _json_dumps(obj, **kwargs)
+    # datetimes and dataclasses go to the registered encoders, int keys become str like json
+    option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS | orjson.OPT_NON_STR_KEYS
+    if kwargs.get("sort_keys"):
+        option |= orjson.OPT_SORT_KEYS
+    if indent == 2:
+        option |= orjson.OPT_INDENT_2
+    try:
+        return orjson.dumps(obj, default=_default, option=option).decode("utf-8")
+    except orjson.JSONEncodeError:
+        # such as integers over 64 bits, json gets them right, or raises the right error
+        return _json_dumps(obj, **kwargs)
+
+
+def _restore(obj, s):
+    "restore the types in a tree parsed by a fast backend, unless the text has no marker at all"
+    if (b'"#' if isinstance(s, (bytes, bytearray)) else '"#') not in s:
         return obj
+    return _restorer._trans_tree(obj)
+
+
+def _orjson_loads(s, **kwargs):
+    if kwargs:
+        return _json_loads(s, **kwargs)
+    try:
+        obj = orjson.loads(s)
+    except orjson.JSONDecodeError:
+        # such as NaN and Infinity, json reads them, or raises the right error
+        return _json_loads(s)
+    return _restore(obj, s)
+
+
+def _ujson_dumps(obj, **kwargs):
+    if set(kwargs) - {"indent", "sort_keys"}:
+        return _json_dumps(obj, **kwargs)
+    try:
+        return ujson.dumps(obj, default=_default, ensure_ascii=False, **kwargs)
+    except (TypeError, OverflowError):
+        return _json_dumps(obj, **kwargs)
+
+
+def _ujson_loads(s, **kwargs):
+    if kwargs:
+        return _json_loads(s, **kwargs)
+    try:
+        obj = ujson.loads(s)
+    except ValueError:
+        return _json_loads(s)
+    return _restore(obj, s)
+
+
+_restorer = CCJSONDecoder()
+
+# name: (dumps, loads), the fast ones first
+BACKENDS = {}
+if orjson:
+    BACKENDS["orjson"] = (_orjson_dumps, _orjson_loads)
+if ujson:
+    BACKENDS["ujson"] = (_ujson_dumps, _ujson_loads)
+BACKENDS["json"] = (_json_dumps, _json_loads)
+
+backend = None
+_dumps = _loads = None
+
+
+def use_backend(name):
+    "switch dumps and loads to a backend in BACKENDS"
+    global backend, _dumps, _loads
+    if name not in BACKENDS:
+        raise ValueError("no such backend: {}".format(name))
+    backend = name
+    _dumps, _loads = BACKENDS[name]
+
+
+# json by default, the fast ones are opt-in, by CCJSON_BACKEND=orjson or use_backend("orjson")
+use_backend(os.environ.get("CCJSON_BACKEND") or "json")
+
+
+def dumps(obj, **kwargs):
+    """json text of obj by the backend in use, with the registered types,
+    kwargs other than indent and sort_keys may take the json path,
+    orjson writes NaN and Infinity as null"""
+    return _dumps(obj, **kwargs)
+
+
+def loads(s, **kwargs):
+    """obj of json text, str or bytes, by the backend in use, with the registered types,
+    orjson reads integers over 64 bits as floats"""
+    return _loads(s, **kwargs)
+
+
+# the binary format is msgpack with these extension types,
+# packb/unpackb use the msgpack package if installed, else the pure python code below
+EXT_TYPE = 0        # a registered type: packed name and packed text of its encoder
+EXT_DATETIME = 1    # int64 microseconds since 1970-01-01, the wall clock, like the text form
+EXT_DATE = 2        # int32 ordinal
+EXT_BIGINT = 3      # decimal text of an int over 64 bits
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+_MICROSECOND = datetime.timedelta(microseconds=1)
+
+_S_B = struct.Struct(">B")
+_S_H = struct.Struct(">H")
+_S_I = struct.Struct(">I")
+_S_Q = struct.Struct(">Q")
+_S_b = struct.Struct(">b")
+_S_h = struct.Struct(">h")
+_S_i = struct.Struct(">i")
+_S_q = struct.Struct(">q")
+_S_d = struct.Struct(">d")
+
+
+def _micros(dt):
+    if dt.tzinfo is not None:
+        dt = dt.replace(tzinfo=None)
+    return (dt - _EPOCH) // _MICROSECOND
+
+
+def _ext(obj):
+    "(code, payload) of a value msgpack has no type for"
+    tp = type(obj)
+    if tp is datetime.datetime:
+        return EXT_DATETIME, _S_q.pack(_micros(obj))
+    if tp is datetime.date:
+        return EXT_DATE, _S_i.pack(obj.toordinal())
+    if tp is int:
+        return EXT_BIGINT, str(obj).encode("ascii")
+    found = _type_handler.encoder_of(tp)
+    if found is None:
+        raise TypeError("Object of type {} is not serializable".format(tp.__name__))
+    name, enc = found
+    out = bytearray()
+    _pack(name, out)
+    _pack(str(enc(obj)), out)
+    return EXT_TYPE, bytes(out)
+
+
+def _unext(code, payload):
+    if code == EXT_DATETIME:
+        return _EPOCH + _S_q.unpack(payload)[0] * _MICROSECOND
+    if code == EXT_DATE:
+        return datetime.date.fromordinal(_S_i.unpack(payload)[0])
+    if code == EXT_BIGINT:
+        return int(payload)
+    if code == EXT_TYPE:
+        name, i = _unpack(payload, 0)
+        data, i = _unpack(payload, i)
+        dec = _type_handler.decoders.get(name)
+        if dec:
+            return dec["func"](data)
+        # like an unknown marker in json
+        return "#{}:{}".format(name, data)
+    raise ValueError("unknown ext type {}".format(code))
+
+
+def _pack_len(n, out, fix, fixmax, codes):
+    "header of a str, bin, array, map or ext, codes: (8 bits or None, 16 bits, 32 bits)"
+    if n <= fixmax:
+        out.append(fix | n)
+    elif codes[0] is not None and n < 0x100:
+        out.append(codes[0])
+        out.append(n)
+    elif n < 0x10000:
+        out.append(codes[1])
+        out += _S_H.pack(n)
+    else:
+        out.append(codes[2])
+        out += _S_I.pack(n)
+
+
+# fixext headers
+_DATETIME_HEAD = bytes((0xd7, EXT_DATETIME))
+_DATE_HEAD = bytes((0xd6, EXT_DATE))
+
+# packed keys of maps, they repeat in most documents
+_keys = {}
+_KEYS_MAX = 4096
+
+
+def _pack_key(k, out):
+    b = _keys.get(k)
+    if b is None:
+        b = bytearray()
+        _pack(k, b)
+        b = bytes(b)
+        if len(_keys) < _KEYS_MAX:
+            _keys[k] = b
+    out += b
+
+
+def _pack_item(v, out):
+    "_pack with the common values inline"
+    tv = type(v)
+    if tv is str:
+        b = v.encode("utf-8")
+        n = len(b)
+        if n < 32:
+            out.append(0xa0 | n)
+            out += b
+        else:
+            _pack_len(n, out, 0xa0, 31, (0xd9, 0xda, 0xdb))
+            out += b
+    elif tv is int and 0 <= v < 0x80:
+        out.append(v)
+    elif tv is datetime.datetime:
+        out += _DATETIME_HEAD
+        out += _S_q.pack(_micros(v))
+    elif tv is datetime.date:
+        out += _DATE_HEAD
+        out += _S_i.pack(v.toordinal())
+    elif tv is float:
+        out.append(0xcb)
+        out += _S_d.pack(v)
+    else:
+        _pack(v, out)
+
+
+def _pack(obj, out):
+    tp = type(obj)
+    if tp is str:
+        b = obj.encode("utf-8")
+        _pack_len(len(b), out, 0xa0, 31, (0xd9, 0xda, 0xdb))
+        out += b
+    elif tp is int:
+        if 0 <= obj < 0x80 or -32 <= obj < 0:
+            out.append(obj & 0xff)
+        elif 0 <= obj < 0x100:
+            out.append(0xcc)
+            out.append(obj)
+        elif 0 <= obj < 0x10000:
+            out.append(0xcd)
+            out += _S_H.pack(obj)
+        elif 0 <= obj < 0x100000000:
+            out.append(0xce)
+            out += _S_I.pack(obj)
+        elif 0 <= obj < 0x10000000000000000:
+            out.append(0xcf)
+            out += _S_Q.pack(obj)
+        elif -0x80 <= obj < 0:
+            out.append(0xd0)
+            out += _S_b.pack(obj)
+        elif -0x8000 <= obj < 0:
+            out.append(0xd1)
+            out += _S_h.pack(obj)
+        elif -0x80000000 <= obj < 0:
+            out.append(0xd2)
+            out += _S_i.pack(obj)
+        elif -0x8000000000000000 <= obj < 0:
+            out.append(0xd3)
+            out += _S_q.pack(obj)
+        else:
+            _pack_ext(obj, out)
+    elif tp is dict:
+        _pack_len(len(obj), out, 0x80, 15, (None, 0xde, 0xdf))
+        for k, v in obj.items():
+            if type(k) is str:
+                _pack_key(k, out)
+            else:
+                _pack(k, out)
+            _pack_item(v, out)
+    elif tp is list or tp is tuple:
+        _pack_len(len(obj), out, 0x90, 15, (None, 0xdc, 0xdd))
+        for o in obj:
+            _pack_item(o, out)
+    elif tp is float:
+        out.append(0xcb)
+        out += _S_d.pack(obj)
+    elif obj is None:
+        out.append(0xc0)
+    elif obj is True:
+        out.append(0xc3)
+    elif obj is False:
+        out.append(0xc2)
+    elif tp is bytes or tp is bytearray:
+        _pack_len(len(obj), out, 0, -1, (0xc4, 0xc5, 0xc6))
+        out += obj
+    else:
+        try:
+            _pack_ext(obj, out)
+        except TypeError:
+            # subclasses of the plain types, like json does
+            for base in (str, int, float, dict, list, tuple):
+                if isinstance(obj, base):
+                    return _pack(base(obj), out)
+            raise
+
+
+_FIXEXT = {1: 0xd4, 2: 0xd5, 4: 0xd6, 8: 0xd7, 16: 0xd8}
+
+def _pack_ext(obj, out):
+    code, payload = _ext(obj)
+    n = len(payload)
+    if n in _FIXEXT:
+        out.append(_FIXEXT[n])
+    else:
+        _pack_len(n, out, 0, -1, (0xc7, 0xc8, 0xc9))
+    out += _S_b.pack(code)
+    out += payload
+
+
+# first byte: (struct of the length or value, size of the struct, kind)
+_HEADS = {
+    0xc4: (_S_B, 1, "bin"), 0xc5: (_S_H, 2, "bin"), 0xc6: (_S_I, 4, "bin"),
+    0xc7: (_S_B, 1, "ext"), 0xc8: (_S_H, 2, "ext"), 0xc9: (_S_I, 4, "ext"),
+    0xca: (struct.Struct(">f"), 4, "value"), 0xcb: (_S_d, 8, "value"),
+    0xcc: (_S_B, 1, "value"), 0xcd: (_S_H, 2, "value"), 0xce: (_S_I, 4, "value"), 0xcf: (_S_Q, 8, "value"),
+    0xd0: (_S_b, 1, "value"), 0xd1: (_S_h, 2, "value"), 0xd2: (_S_i, 4, "value"), 0xd3: (_S_q, 8, "value"),
+    0xd9: (_S_B, 1, "str"), 0xda: (_S_H, 2, "str"), 0xdb: (_S_I, 4, "str"),
+    0xdc: (_S_H, 2, "array"), 0xdd: (_S_I, 4, "array"),
+    0xde: (_S_H, 2, "map"), 0xdf: (_S_I, 4, "map"),
+}
+_FIXEXT_SIZES = {0xd4: 1, 0xd5: 2, 0xd6: 4, 0xd7: 8, 0xd8: 16}
+_CONSTS = {0xc0: None, 0xc2: False, 0xc3: True}
+
+
+def _unpack_item(data, i):
+    "_unpack with the common values inline"
+    b = data[i]
+    if b < 0x80:
+        return b, i + 1
+    if 0xa0 <= b < 0xc0:
+        n = b & 0x1f
+        i += 1
+        return data[i:i + n].decode("utf-8"), i + n
+    if b == 0xd7 and data[i + 1] == EXT_DATETIME:
+        return _EPOCH + _S_q.unpack_from(data, i + 2)[0] * _MICROSECOND, i + 10
+    if b == 0xd6 and data[i + 1] == EXT_DATE:
+        return datetime.date.fromordinal(_S_i.unpack_from(data, i + 2)[0]), i + 6
+    if b == 0xcb:
+        return _S_d.unpack_from(data, i + 1)[0], i + 9
+    return _unpack(data, i)
+
+
+def _truncated(data):
+    return ValueError("truncated data of {} bytes".format(len(data)))
+
+
+def _unpack_ext(data, i, n):
+    "the ext of code data[i] and n bytes of payload"
+    if i + 1 + n > len(data):
+        # a short payload would go to the decoders
+        raise _truncated(data)
+    code = _S_b.unpack_from(data, i)[0]
+    return _unext(code, bytes(data[i + 1:i + 1 + n])), i + 1 + n
+
+
+def _unpack(data, i):
+    "return the object starting at data[i], and the index after it"
+    b = data[i]
+    i += 1
+    if b < 0x80:
+        return b, i
+    if b >= 0xe0:
+        return b - 0x100, i
+    if b < 0x90:
+        n, kind = b & 0x0f, "map"
+    elif b < 0xa0:
+        n, kind = b & 0x0f, "array"
+    elif b < 0xc0:
+        n = b & 0x1f
+        return data[i:i + n].decode("utf-8"), i + n
+    elif b in _CONSTS:
+        return _CONSTS[b], i
+    elif b in _FIXEXT_SIZES:
+        return _unpack_ext(data, i, _FIXEXT_SIZES[b])
+    else:
+        head = _HEADS.get(b)
+        if head is None:
+            raise ValueError("bad byte 0x{:02x} at {}".format(b, i - 1))
+        st, size, kind = head
+        n = st.unpack_from(data, i)[0]
+        i += size
+        if kind == "value":
+            return n, i
+        if kind == "str":
+            return data[i:i + n].decode("utf-8"), i + n
+        if kind == "bin":
+            return bytes(data[i:i + n]), i + n
+        if kind == "ext":
+            return _unpack_ext(data, i, n)
+    if kind == "array":
+        lst = [None] * n
+        for j in range(n):
+            lst[j], i = _unpack_item(data, i)
+        return lst, i
+    obj = {}
+    for _ in range(n):
+        b = data[i]
+        # str keys are the most common
+        if 0xa0 <= b < 0xc0:
+            b &= 0x1f
+            i += 1
+            key = data[i:i + b].decode("utf-8")
+            i += b
+        else:
+            key, i = _unpack(data, i)
+        obj[key], i = _unpack_item(data, i)
+    return obj, i
+
+
+def _msgpack_default(obj):
+    return msgpack.ExtType(*_ext(obj))
+
+
+def packb(obj):
+    """bytes of obj in the binary format, with the registered types,
+    about half the size of the json text"""
+    if msgpack:
+        try:
+            return msgpack.packb(obj, default=_msgpack_default, use_bin_type=True)
+        except OverflowError:
+            pass
+    out = bytearray()
+    _pack(obj, out)
+    return bytes(out)
+
+
+def unpackb(data):
+    """obj of bytes in the binary format, with the registered types,
+    loading faster than json needs the msgpack package, the pure python
+    code is a bit slower than the json decoder"""
+    if msgpack:
+        return msgpack.unpackb(data, raw=False, strict_map_key=False, ext_hook=_unext)
+    if not isinstance(data, (bytes, bytearray)):
+        # memoryview and the like, their slices can't decode
+        data = bytes(data)
+    try:
+        obj, i = _unpack(data, 0)
+    except (IndexError, struct.error):
+        i = len(data) + 1
+    except UnicodeDecodeError as e:
+        if e.reason != "unexpected end of data":
+            raise
+        i = len(data) + 1
+    # slices past the end are only short, so the index tells
+    if i > len(data):
+        raise _truncated(data)
+    if i != len(data):
+        raise ValueError("{} bytes of extra data".format(len(data) - i))
+    return obj
 
 
 if __name__ == "__main__":
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+
+import datetime
+import json
+import os
+import subprocess
+import tempfile
+import time
+
+import ccjson
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+class Point:
+    "a custom type, registered as \"point\""
+
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+
+    def __eq__(self, other):
+        return isinstance(other, Point) and (self.x, self.y) == (other.x, other.y)
+
+
+def register_types(extra):
+    "register Point, and `extra` more types that are never used, as a busy registry"
+    ccjson.register_enc(Point, "point", lambda p: "{},{}".format(p.x, p.y))
+    ccjson.register_dec(Point, "point", lambda s: Point(*map(int, s.split(","))))
+    for i in range(extra):
+        tp = type("Unused{}".format(i), (), {})
+        ccjson.register_enc(tp, tp.__name__, str)
+        ccjson.register_dec(tp, tp.__name__, tp)
+
+
+def make_document(records):
+    "a list of records with datetimes, dates, a custom type and plain values"
+    start = datetime.datetime(2020, 1, 1)
+    doc = []
+    for i in range(records):
+        t = start + datetime.timedelta(seconds=i * 37)
+        doc.append({
+            "id": i,
+            "name": "record {}".format(i),
+            "created": t,
+            "updated": t + datetime.timedelta(hours=1),
+            "day": t.date(),
+            "where": Point(i, -i),
+            "tags": ["a", "b", "#not:a marker"],
+            "score": i * 0.5,
+        })
+    return doc
+
+
+def make_plain_document(records):
+    "records of plain json values only, no marker to restore"
+    return [{
+        "id": i,
+        "name": "record {}".format(i),
+        "created": "2020-01-01 00:00:00",
+        "tags": ["a", "b", "c"],
+        "score": i * 0.5,
+        "ok": i % 2 == 0,
+    } for i in range(records)]
+
+
+def timed(func, repeat):
+    "the best seconds of `repeat` calls, and the last result"
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        cost = time.perf_counter() - start
+        best = cost if best is None else min(best, cost)
+    return best, result
+
+
+def bench_encode(doc, repeat):
+    cost, text = timed(lambda: json.dumps(doc, cls=ccjson.CCJSONEncoder), repeat)
+    return {"seconds": cost, "mb_per_sec": len(text) / cost / 1024 / 1024}, text
+
+
+def bench_decode(text, doc, repeat):
+    cost, back = timed(lambda: json.loads(text, cls=ccjson.CCJSONDecoder), repeat)
+    assert back == doc
+    return {"seconds": cost, "mb_per_sec": len(text) / cost / 1024 / 1024}
+
+
+def bench_backend(name, doc, repeat):
+    "ccjson.dumps and ccjson.loads by a backend"
+    ccjson.use_backend(name)
+    enc, text = timed(lambda: ccjson.dumps(doc), repeat)
+    dec, back = timed(lambda: ccjson.loads(text), repeat)
+    assert back == doc
+    size = len(text.encode("utf-8"))
+    return (
+        {"seconds": enc, "mb_per_sec": size / enc / 1024 / 1024},
+        {"seconds": dec, "mb_per_sec": size / dec / 1024 / 1024},
+    )
+
+
+def bench_binary(doc, repeat):
+    "packb and unpackb, the binary format"
+    enc, data = timed(lambda: ccjson.packb(doc), repeat)
+    dec, back = timed(lambda: ccjson.unpackb(data), repeat)
+    assert back == doc
+    return (
+        {"seconds": enc, "mb_per_sec": len(data) / enc / 1024 / 1024},
+        {"seconds": dec, "mb_per_sec": len(data) / dec / 1024 / 1024},
+        len(data),
+    )
+
+
+def bench_stream(doc, repeat):
+    "dump_array into a file and iter_array it back, one record at a time"
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "doc.json")
+
+        def dump():
+            with open(path, "w") as fp:
+                ccjson.dump_array(doc, fp)
+
+        def load():
+            with open(path, "rb") as fp:
+                return list(ccjson.iter_array(fp))
+
+        enc, _ = timed(dump, repeat)
+        size = os.path.getsize(path)
+        dec, back = timed(load, repeat)
+    assert back == doc
+    return (
+        {"seconds": enc, "mb_per_sec": size / enc / 1024 / 1024},
+        {"seconds": dec, "mb_per_sec": size / dec / 1024 / 1024},
+    )
+
+
+def run(args):
+    register_types(args.types)
+    doc = make_document(args.records)
+    results = {}
+    results["encode"], text = bench_encode(doc, args.repeat)
+    results["decode"] = bench_decode(text, doc, args.repeat)
+    results["stream_encode"], results["stream_decode"] = bench_stream(doc, args.repeat)
+    plain = make_plain_document(args.records)
+    for name in ccjson.BACKENDS:
+        results[name + ".dumps"], results[name + ".loads"] = bench_backend(name, doc, args.repeat)
+        results[name + ".dumps_plain"], results[name + ".loads_plain"] = bench_backend(
+            name, plain, args.repeat)
+    results["binary.pack"], results["binary.unpack"], size = bench_binary(doc, args.repeat)
+    results["size"] = {"mb": len(text) / 1024 / 1024, "binary_mb": size / 1024 / 1024}
+    return results
+
+
+def revision():
+    try:
+        out = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=HERE,
+                                      stderr=subprocess.DEVNULL)
+        return out.decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report(results, baseline=None):
+    base = baseline["results"] if baseline else {}
+    for name, result in results.items():
+        for key, value in result.items():
+            line = "{:<24} {:<12} {:>12.3f}".format(name, key, value)
+            old = base.get(name, {}).get(key)
+            if old:
+                line += "  {:>+8.1f}%".format((value - old) / old * 100)
+            print(line)
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="benchmark of ccjson.py")
+    parser.add_argument("--records", type=int, default=100000,
+                        help="records of the document, each has 3 datetime or date values")
+    parser.add_argument("--types", type=int, default=50, help="unused types registered besides")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="save the results into this json file")
+    parser.add_argument("--compare", help="json file of an earlier run to compare with")
+    args = parser.parse_args(argv)
+
+    results = run(args)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)
+    report(results, baseline)
+    if args.output:
+        params = {k: v for k, v in vars(args).items() if k not in ("output", "compare")}
+        with open(args.output, "w") as fp:
+            json.dump({"revision": revision(), "time": time.time(), "params": params,
+                       "results": results}, fp, indent=2)
+
+
+if __name__ == "__main__":
+    main()
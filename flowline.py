@@ -1,9 +1,18 @@
 #!/usr/bin/env python3
 
+import asyncio
+import cProfile
+import inspect
+import pstats
 import traceback
 import threading
-import queue
+import collections
+import multiprocessing
 import logging
+import os
+import pickle
+import sqlite3
+import sys
 import time
 
 
@@ -16,57 +25,862 @@ class Error(Exception):
 class NotReady(Error):
     pass
 
+class Finished(Error):
+    "no more data will come from a line"
+    pass
+
+
+class Line:
+    """a queue between workers,
+    get blocks until an item arrives or all the producers are done,
+    so workers wake on data instead of polling,
+    put blocks while `capacity` items are queued, unless no consumer is left,
+    capacity 0 is unbounded."""
+
+    def __init__(self, capacity=0):
+        self.producer = 0
+        self.consumer = 0
+        self.inline = None
+        self.capacity = capacity
+        self.high_water = 0
+        self.blocked = 0
+        self._items = collections.deque()
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+
+    def __len__(self):
+        return len(self._items)
+
+    def empty(self):
+        return not self._items
+
+    def finished(self):
+        return self.producer <= 0 and not self._items
+
+    def stats(self):
+        return {
+            "size": len(self._items),
+            "capacity": self.capacity,
+            "high_water": self.high_water,
+            "blocked": self.blocked,
+        }
+
+    def put(self, item):
+        with self._lock:
+            if self.capacity and len(self._items) >= self.capacity and self.consumer > 0:
+                self.blocked += 1
+                while len(self._items) >= self.capacity and self.consumer > 0:
+                    self._not_full.wait()
+            self._items.append(item)
+            if len(self._items) > self.high_water:
+                self.high_water = len(self._items)
+            self._not_empty.notify()
+
+    def get(self, timeout=None):
+        "raise NotReady if nothing arrives in `timeout` seconds"
+        with self._lock:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while not self._items:
+                if self.producer <= 0:
+                    raise Finished
+                if deadline is None:
+                    self._not_empty.wait()
+                else:
+                    left = deadline - time.monotonic()
+                    if left <= 0:
+                        raise NotReady
+                    self._not_empty.wait(left)
+            if self.capacity:
+                self._not_full.notify()
+            return self._items.popleft()
+
+    def get_many(self, n, wait=0, timeout=None):
+        """take at most n items, block for the first like get,
+        then wait at most `wait` seconds for the rest."""
+        with self._lock:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while not self._items:
+                if self.producer <= 0:
+                    raise Finished
+                if deadline is None:
+                    self._not_empty.wait()
+                else:
+                    left = deadline - time.monotonic()
+                    if left <= 0:
+                        raise NotReady
+                    self._not_empty.wait(left)
+            if wait and len(self._items) < n:
+                deadline = time.monotonic() + wait
+                while len(self._items) < n and self.producer > 0:
+                    left = deadline - time.monotonic()
+                    if left <= 0:
+                        break
+                    self._not_empty.wait(left)
+            items = self._items
+            if len(items) <= n:
+                self._items = collections.deque()
+                items = list(items)
+            else:
+                items = [items.popleft() for _ in range(n)]
+            if self.capacity:
+                self._not_full.notify_all()
+            return items
+
+    def put_many(self, items):
+        with self._lock:
+            i = 0
+            while i < len(items):
+                if self.capacity and self.consumer > 0:
+                    if len(self._items) >= self.capacity:
+                        self.blocked += 1
+                        while len(self._items) >= self.capacity and self.consumer > 0:
+                            self._not_full.wait()
+                    room = self.capacity - len(self._items) if self.consumer > 0 else len(items)
+                else:
+                    room = len(items)
+                self._items.extend(items[i:i + room])
+                i += room
+                if len(self._items) > self.high_water:
+                    self.high_water = len(self._items)
+                self._not_empty.notify_all()
+
+    def add_consumer(self):
+        with self._lock:
+            self.consumer += 1
+
+    def remove_consumer(self):
+        with self._lock:
+            self.consumer -= 1
+            if self.consumer <= 0:
+                # nobody will take them, stop blocking the producers
+                self._not_full.notify_all()
+
+    def add_producer(self):
+        with self._lock:
+            self.producer += 1
+
+    def remove_producer(self):
+        "return True if it's the last producer"
+        with self._lock:
+            self.producer -= 1
+            if self.producer <= 0:
+                # wake up all the consumers to see the end
+                self._not_empty.notify_all()
+                return True
+        return False
+
+
+def _call(do_work, args, retries=0, backoff=0):
+    "call do_work, when it fails, retry after backoff, 2 * backoff, ... seconds"
+    attempt = 0
+    while True:
+        try:
+            return do_work(*args)
+        except Exception as e:  # noqa
+            if attempt >= retries:
+                raise
+            log.warning("%s failed, retry %d: %r", do_work.__name__, attempt + 1, e)
+            time.sleep(backoff * 2 ** attempt)
+            attempt += 1
+
+
+# do_work of the stage running in a pool process, and its retries, set by the pool initializer
+_stage_work = None
+_stage_retry = (0, 0)
+
+def _init_stage(do_work, retries, backoff):
+    global _stage_work, _stage_retry
+    _stage_work = do_work
+    _stage_retry = (retries, backoff)
+
+def _run_chunk(chunk):
+    "run a chunk of args in a pool process, errors come back as text, with the seconds cost"
+    results = []
+    for args in chunk:
+        start = time.perf_counter()
+        try:
+            results.append((True, _call(_stage_work, args, *_stage_retry), time.perf_counter() - start))
+        except Exception as e:  # noqa
+            err = traceback.format_exception(Exception, e, e.__traceback__)
+            results.append((False, "".join(err), time.perf_counter() - start))
+    return results
+
+
+def _repr_key(*args):
+    return repr(args)
+
+
+class Ledger:
+    """the work done by stages in a sqlite file, with pickled outputs,
+    so a restarted run puts the outputs again instead of doing the work,
+    commits every `interval` seconds and at close."""
+
+    def __init__(self, path, interval=1):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS done "
+                          "(stage TEXT, key TEXT, output BLOB, PRIMARY KEY (stage, key))")
+        self.conn.commit()
+        self.committed = time.monotonic()
+
+    def get(self, stage, key):
+        "return (True, output) if done"
+        with self.lock:
+            row = self.conn.execute("SELECT output FROM done WHERE stage = ? AND key = ?",
+                                    (stage, key)).fetchone()
+        if row is None:
+            return False, None
+        return True, pickle.loads(row[0])
+
+    def done(self, stage, items):
+        "items: [(key, output)]"
+        rows = [(stage, key, pickle.dumps(output, pickle.HIGHEST_PROTOCOL)) for key, output in items]
+        with self.lock:
+            self.conn.executemany("INSERT OR REPLACE INTO done VALUES (?, ?, ?)", rows)
+            if time.monotonic() - self.committed >= self.interval:
+                self.conn.commit()
+                self.committed = time.monotonic()
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
+
+
+def _percentile(ss, q):
+    if not ss:
+        return None
+    return ss[min(len(ss) - 1, len(ss) * q // 100)]
+
+
+class StageStats:
+    """counters of a replica, only its own thread writes them,
+    busy is the time in do_work, idle is the time waiting for args."""
+    LATENCIES = 1024
+
+    def __init__(self):
+        self.items_in = 0
+        self.items_out = 0
+        self.errors = 0
+        # done in an earlier run
+        self.skipped = 0
+        self.busy = 0.0
+        self.idle = 0.0
+        self.started = time.perf_counter()
+        self.stopped = None
+        # seconds of the latest calls of do_work
+        self.latencies = collections.deque(maxlen=self.LATENCIES)
+
+    def wall(self):
+        return (self.stopped or time.perf_counter()) - self.started
+
+
+class KeyedJoin:
+    """match items of upstreams by key(item), unmatched items wait in
+    a table per upstream, matched args come out in the order they complete."""
+
+    def __init__(self, key, ways):
+        self.key = key
+        self.pending = [{} for _ in range(ways)]
+        self.lock = threading.Lock()
+
+    def add(self, i, item):
+        "return the args if the item completes them, else keep it"
+        k = self.key(item)
+        with self.lock:
+            others = [p.get(k) for j, p in enumerate(self.pending) if j != i]
+            if not all(others):
+                self.pending[i].setdefault(k, collections.deque()).append(item)
+                return None
+            args = []
+            for j, p in enumerate(self.pending):
+                if j == i:
+                    args.append(item)
+                    continue
+                waiting = p[k]
+                args.append(waiting.popleft())
+                if not waiting:
+                    del p[k]
+            return args
+
+    def unmatched(self):
+        with self.lock:
+            return sum(len(q) for p in self.pending for q in p.values())
+
+
+class Stage:
+    "a resgisted worker and its replicas"
+
+    def __init__(self, do_work, upstream, downstream, **kwargs):
+        self.do_work = do_work
+        self.name = do_work.__name__
+        self.upstream = upstream
+        self.downstream = downstream
+        self.executor = kwargs.get("executor", "thread")
+        self.concurrency = kwargs.get("concurrency", 1)
+        self.autoscale = kwargs.get("autoscale")
+        self.chunk = kwargs.get("chunk", FlowLine.CHUNK)
+        self.batch = kwargs.get("batch", 0)
+        self.batch_wait = kwargs.get("batch_wait", 0)
+        # the upstream names given, upstream is the line of matched args for a keyed join
+        self.sources = kwargs.get("sources", upstream)
+        self.join = kwargs.get("join")
+        self.profile = kwargs.get("profile", False)
+        self.profile_stats = None
+        self.key = kwargs.get("key") or _repr_key
+        self.retries = kwargs.get("retries", 0)
+        self.backoff = kwargs.get("backoff", 0)
+        self.dead_letter = kwargs.get("dead_letter")
+        # lines it puts into
+        self.feeds = downstream + ([self.dead_letter] if self.dead_letter else [])
+        # an args is a list, else an item for one upstream
+        self.multi = bool(self.join) or len(upstream) > 1
+        # name in the ledger, set when starting
+        self.id = self.name
+        self.pumps = 0
+        self.replicas = 0
+        self.pool = None
+        self.lock = threading.Lock()
+        # hold while taking one args across upstreams, so replicas don't mix them up
+        self.join_lock = threading.Lock()
+        self.stats = []
+        self.depths = collections.deque(maxlen=FlowLine.DEPTH_SAMPLES)
+        self._local = threading.local()
+
+    def new_stats(self):
+        stats = StageStats()
+        with self.lock:
+            self.stats.append(stats)
+        return stats
+
+    def local_stats(self):
+        "stats of the calling thread, an inline worker runs in threads of its upstream"
+        stats = getattr(self._local, "stats", None)
+        if stats is None:
+            stats = self._local.stats = self.new_stats()
+        return stats
+
+    def add_profile(self, prof):
+        with self.lock:
+            if self.profile_stats is None:
+                self.profile_stats = pstats.Stats(prof)
+            else:
+                self.profile_stats.add(prof)
+
+    def snapshot(self):
+        with self.lock:
+            stats = list(self.stats)
+        latencies = []
+        for st in stats:
+            latencies.extend(st.latencies)
+        latencies.sort()
+        busy = sum(st.busy for st in stats)
+        idle = sum(st.idle for st in stats)
+        wall = sum(st.wall() for st in stats)
+        # processes of a pool are busy at the same time
+        workers = self.concurrency if self.executor == "process" else 1
+        p50, p99 = _percentile(latencies, 50), _percentile(latencies, 99)
+        depths = list(self.depths)
+        return {
+            "replicas": self.replicas,
+            "items_in": sum(st.items_in for st in stats),
+            "items_out": sum(st.items_out for st in stats),
+            "errors": sum(st.errors for st in stats),
+            "skipped": sum(st.skipped for st in stats),
+            "busy": busy,
+            "idle": idle,
+            "busy_ratio": busy / (wall * workers) if wall else 0,
+            "latency_ms_p50": None if p50 is None else p50 * 1000,
+            "latency_ms_p99": None if p99 is None else p99 * 1000,
+            "depth_avg": sum(depths) / len(depths) if depths else None,
+            "depth_max": max(depths) if depths else None,
+        }
+
 
 class FlowLine:
-    SLEEPING = 1
+    EXECUTORS = ("thread", "process", "inline")
+    CHUNK = 64
+    AUTOSCALE_INTERVAL = 0.1
+    AUTOSCALE_DEPTH = 8
+    AUTOSCALE_IDLE = 1
+    RETRY_BACKOFF = 0.5
+    SAMPLE_INTERVAL = 0.5
+    DEPTH_SAMPLES = 600
 
     def __init__(self, **kwargs):
-        self.sleeping = kwargs.get("sleeping", self.SLEEPING)
+        """kwargs:
+        capacity: max items queued in a line, 0 for unbounded, the default,
+        capacities: {line name: capacity} for some lines,
+        autoscale_interval, autoscale_depth, autoscale_idle: see resgist,
+        sample_interval: seconds between samples of the queue depths,
+        report_interval: seconds between reports logged while running, 0 for none,
+        checkpoint: path of a sqlite file to keep the work done by the stages,
+        a run with the same file and the same resgisted stages skips them,
+        producers run again, and their items are passed on with the kept outputs."""
+        self.capacity = kwargs.get("capacity", 0)
+        self.capacities = kwargs.get("capacities", {})
         self.lines = {}
-        self.lock = threading.Lock()
         self.workers = []
+        self.stages = []
+        self.autoscale_interval = kwargs.get("autoscale_interval", self.AUTOSCALE_INTERVAL)
+        self.autoscale_depth = kwargs.get("autoscale_depth", self.AUTOSCALE_DEPTH)
+        self.autoscale_idle = kwargs.get("autoscale_idle", self.AUTOSCALE_IDLE)
+        self.sample_interval = kwargs.get("sample_interval", self.SAMPLE_INTERVAL)
+        self.report_interval = kwargs.get("report_interval", 0)
+        self.checkpoint = kwargs.get("checkpoint")
+        self.ledger = None
 
-    def resgist(self, do_work, upstream=None, downstream=None):
+    def resgist(self, do_work, upstream=None, downstream=None,
+                executor="thread", concurrency=None, autoscale=None, chunk=CHUNK,
+                batch=0, batch_wait=0, join_key=None, profile=False,
+                key=None, retries=0, backoff=RETRY_BACKOFF, dead_letter=None):
         """resgist a worker with upstream and downstream,
         if no upstream, it's a pure producer, and should be a generator,
         else take args from upstream,
-        then put output into downstreams."""
+        then put output into downstreams.
+        executor is where do_work runs:
+        "thread", in `concurrency` threads, 1 by default,
+        "process", in a pool of `concurrency` processes, cpu count by default,
+        a thread feeds it with chunks of at most `chunk` args, for cpu bound
+        works, args and outputs should be picklable,
+        "inline", in the thread of the upstream worker when it puts, so no
+        queue at all, for cheap works, only one upstream and no other
+        consumers of it, and do_work should be thread safe.
+        autoscale=(min, max) is for "thread" workers, 1 <= min <= max, a thread
+        is added when upstreams are `autoscale_depth` items per thread deep,
+        and leaves when idle for `autoscale_idle` seconds.
+        batch=N is for "thread" workers, do_work takes a list of at most N
+        args, as many as arrived in `batch_wait` seconds after the first,
+        every args is an item for one upstream and a list for more,
+        and returns a list of outputs, a producer yields lists of outputs,
+        outputs are put to each downstream with one lock.
+        with more upstreams, the i-th items of them are the i-th args, unless
+        join_key is given, then items with the same join_key(item) are the args,
+        a thread per upstream matches them, and items never matched are dropped.
+        profile=True runs "thread" workers under cProfile, see profile(),
+        since python 3.12 only one thread of a FlowLine can be profiled.
+        key(*args) is the key of args in the checkpoint, repr of args by default,
+        outputs should be picklable, and a batch worker returns an output for
+        every args in order.
+        a failed do_work is called again `retries` times, after backoff,
+        2 * backoff, ... seconds, then the args are dropped, or put into the
+        line `dead_letter` as {"worker": name, "args": args, "error": text}."""
+        if executor not in self.EXECUTORS:
+            raise Error("no such executor: {}".format(executor))
         upstream = self._make_list(upstream)
         downstream = self._make_list(downstream)
-        def worker():
-            log.info("worker %s start to work", do_work.__name__)
-            if not upstream:
-                for output in do_work():
-                    output = self._make_list(output)
-                    self.put_args(output, downstream)
+        name = do_work.__name__
+        if executor != "thread" and not upstream:
+            raise Error("producer {} should run in a thread".format(name))
+        if executor == "inline" and len(upstream) != 1:
+            raise Error("inline worker {} should have one upstream".format(name))
+        if executor == "inline" and (concurrency or 1) > 1:
+            raise Error("inline worker {} has no concurrency".format(name))
+        if autoscale and (executor != "thread" or not upstream):
+            raise Error("only thread worker with upstream can autoscale: {}".format(name))
+        if autoscale and not 1 <= autoscale[0] <= autoscale[1]:
+            # with no replica left, the downstreams are finished
+            raise Error("worker {} should autoscale with 1 <= min <= max".format(name))
+        if batch and executor != "thread":
+            raise Error("only thread worker can batch: {}".format(name))
+        if profile and executor != "thread":
+            raise Error("only thread worker can be profiled: {}".format(name))
+        if profile and sys.version_info >= (3, 12):
+            # since 3.12 only one profiler can be active in a process
+            threads = autoscale[1] if autoscale else concurrency or 1
+            if threads > 1 or any(st.profile for st in self.stages):
+                raise Error("only one thread can be profiled since python 3.12: {}".format(name))
+        if join_key and len(upstream) < 2:
+            raise Error("worker {} has nothing to join".format(name))
+
+        if autoscale:
+            concurrency = autoscale[0]
+        if executor == "process":
+            concurrency = concurrency or os.cpu_count()
+        sources = upstream
+        join = None
+        if join_key:
+            # pumps match the items of upstreams into a line of args
+            join = KeyedJoin(join_key, len(sources))
+            upstream = ["{}#{}.join".format(name, len(self.stages))]
+        stage = Stage(do_work, upstream, downstream, executor=executor, concurrency=concurrency or 1,
+                      autoscale=autoscale, chunk=chunk, batch=batch, batch_wait=batch_wait,
+                      sources=sources, join=join, profile=profile, key=key,
+                      retries=retries, backoff=backoff, dead_letter=dead_letter)
+        self.stages.append(stage)
+        for i, u in enumerate(sources if join else ()):
+            stage.pumps += 1
+            w = threading.Thread(target=self._pump, args=(stage, i, u))
+            self.recruit_worker(w, [u], upstream)
+
+        if executor == "inline":
+            self.recruit_worker(None, upstream, stage.feeds)
+            self.lines[upstream[0]].inline = (
+                lambda arg: self._work(stage, [arg], stage.local_stats()),
+                lambda: self.fire_worker(stage.feeds))
+            return
+
+        # a process pool is fed by one thread
+        replicas = 1 if executor == "process" else stage.concurrency
+        for _ in range(replicas):
+            stage.replicas += 1
+            w = threading.Thread(target=self._replica, args=(stage,))
+            self.recruit_worker(w, upstream, stage.feeds)
+
+    def _replica(self, stage):
+        log.info("worker %s start to work", stage.name)
+        stats = stage.new_stats()
+        left = False
+        prof = None
+        try:
+            if stage.profile:
+                # collected only once enabled, an empty one can't make pstats
+                p = cProfile.Profile()
+                p.enable()
+                prof = p
+            if not stage.upstream:
+                start = time.perf_counter()
+                for output in stage.do_work():
+                    stats.busy += time.perf_counter() - start
+                    if stage.batch:
+                        stats.items_out += self.put_batch(output, stage.downstream)
+                    else:
+                        output = self._make_list(output)
+                        stats.items_out += self.put_args(output, stage.downstream)
+                    start = time.perf_counter()
+            elif stage.executor == "process":
+                self._process_work(stage, stats)
             else:
+                timeout = self.autoscale_idle if stage.autoscale else None
                 while True:
+                    start = time.perf_counter()
                     try:
-                        args = self.get_args(upstream)
-                        output = do_work(*args)
-                        output = self._make_list(output)
-                        self.put_args(output, downstream)
-                    except NotReady:
-                        time.sleep(self.sleeping)
-                    except Exception as e:  # noqa
-                        err = traceback.format_exception(Exception, e, e.__traceback__)
-                        log.error("%s error with args:%s", do_work.__name__, args)
-                        log.error("%s", "".join(err))
-                    if self.finished(upstream):
+                        if stage.batch:
+                            args = self._take_batch(stage, timeout)
+                        else:
+                            args = self._take(stage, timeout)
+                    except Finished:
                         break
-            self.fire_worker(downstream)
-            log.info("job of worker %s is done", do_work.__name__)
+                    except NotReady:
+                        # idle, leave if there are more than enough
+                        with stage.lock:
+                            if stage.replicas > stage.autoscale[0]:
+                                stage.replicas -= 1
+                                left = True
+                        if left:
+                            break
+                        continue
+                    finally:
+                        stats.idle += time.perf_counter() - start
+                    if stage.batch:
+                        self._work_batch(stage, args, stats)
+                    else:
+                        self._work(stage, args, stats)
+        finally:
+            stats.stopped = time.perf_counter()
+            if prof:
+                prof.disable()
+                stage.add_profile(prof)
+            with stage.lock:
+                if not left:
+                    stage.replicas -= 1
+                self.fire_worker(stage.feeds)
+            for u in stage.upstream:
+                self.lines[u].remove_consumer()
+        log.info("job of worker %s is done", stage.name)
 
-        w = threading.Thread(target=worker)
-        self.recruit_worker(w, upstream, downstream)
+    def _pump(self, stage, i, u):
+        line = self.lines[u]
+        out = self.lines[stage.upstream[0]]
+        while True:
+            try:
+                item = line.get()
+            except Finished:
+                break
+            args = stage.join.add(i, item)
+            if args:
+                out.put(args)
+        with stage.lock:
+            stage.pumps -= 1
+            last = stage.pumps == 0
+            self.fire_worker(stage.upstream)
+        line.remove_consumer()
+        if last:
+            unmatched = stage.join.unmatched()
+            if unmatched:
+                log.warning("worker %s dropped %d unmatched items", stage.name, unmatched)
 
+    def _take(self, stage, timeout=None):
+        "take the args of a stage"
+        if stage.join:
+            return self.lines[stage.upstream[0]].get(timeout)
+        if len(stage.upstream) == 1:
+            return self.get_args(stage.upstream, timeout)
+        if not stage.join_lock.acquire(timeout=-1 if timeout is None else timeout):
+            raise NotReady
+        try:
+            return self.get_args(stage.upstream, timeout)
+        finally:
+            stage.join_lock.release()
 
-    def start(self):
-        for w in self.workers:
+    def _take_batch(self, stage, timeout=None):
+        """take at most `batch` args, as many as arrive in `batch_wait` seconds after
+        the first, an args is an item for one upstream and a list of items for more."""
+        if stage.join or len(stage.upstream) == 1:
+            return self.lines[stage.upstream[0]].get_many(stage.batch, stage.batch_wait, timeout)
+        batch = [self._take(stage, timeout)]
+        deadline = time.monotonic() + stage.batch_wait
+        while len(batch) < stage.batch:
+            try:
+                batch.append(self._take(stage, max(0, deadline - time.monotonic())))
+            except (NotReady, Finished):
+                break
+        return batch
+
+    def _scale_up(self, stage):
+        with stage.lock:
+            # once all replicas are gone, the downstreams may be finished
+            if stage.replicas == 0 or stage.replicas >= stage.autoscale[1]:
+                return
+            stage.replicas += 1
+            w = threading.Thread(target=self._replica, args=(stage,))
+            self.recruit_worker(w, stage.upstream, stage.feeds)
             w.start()
-        for w in self.workers:
-            w.join()
+        log.debug("worker %s scales up to %d", stage.name, stage.replicas)
+
+    def _autoscaler(self, stages):
+        while any(stage.replicas for stage in stages):
+            for stage in stages:
+                depth = sum(len(self.lines[u]) for u in stage.upstream)
+                if depth > stage.replicas * self.autoscale_depth:
+                    self._scale_up(stage)
+            time.sleep(self.autoscale_interval)
 
+    def _skip_done(self, stage, batch, stats, batched=False):
+        "put the outputs of args done in an earlier run, return the rest and their keys"
+        todo, keys, outputs = [], [], []
+        for args in batch:
+            key = stage.key(args) if batched and not stage.multi else stage.key(*args)
+            found, output = self.ledger.get(stage.id, key)
+            if found:
+                outputs.append(output)
+            else:
+                todo.append(args)
+                keys.append(key)
+        if outputs:
+            stats.skipped += len(outputs)
+            stats.items_out += self.put_batch(outputs, stage.downstream)
+        return todo, keys
+
+    def _failed(self, stage, batch, err):
+        if stage.dead_letter:
+            dead = self.lines[stage.dead_letter]
+            for args in batch:
+                dead.put({"worker": stage.name, "args": args, "error": err})
+
+    def _work(self, stage, args, stats):
+        stats.items_in += 1
+        if self.ledger:
+            todo, keys = self._skip_done(stage, [args], stats)
+            if not todo:
+                return
+        try:
+            start = time.perf_counter()
+            output = _call(stage.do_work, args, stage.retries, stage.backoff)
+            cost = time.perf_counter() - start
+            stats.busy += cost
+            stats.latencies.append(cost)
+            if self.ledger:
+                self.ledger.done(stage.id, [(keys[0], output)])
+            output = self._make_list(output)
+            stats.items_out += self.put_args(output, stage.downstream)
+        except Exception as e:  # noqa
+            stats.errors += 1
+            err = "".join(traceback.format_exception(Exception, e, e.__traceback__))
+            log.error("%s error with args:%s", stage.name, args)
+            log.error("%s", err)
+            self._failed(stage, [args], err)
+
+    def _work_batch(self, stage, batch, stats):
+        stats.items_in += len(batch)
+        if self.ledger:
+            batch, keys = self._skip_done(stage, batch, stats, batched=True)
+            if not batch:
+                return
+        try:
+            start = time.perf_counter()
+            outputs = _call(stage.do_work, [batch], stage.retries, stage.backoff)
+            cost = time.perf_counter() - start
+            stats.busy += cost
+            stats.latencies.append(cost)
+            if self.ledger:
+                outputs = list(outputs)
+                if len(outputs) != len(batch):
+                    raise Error("{} outputs for a batch of {}".format(len(outputs), len(batch)))
+                self.ledger.done(stage.id, zip(keys, outputs))
+            stats.items_out += self.put_batch(outputs, stage.downstream)
+        except Exception as e:  # noqa
+            stats.errors += 1
+            err = "".join(traceback.format_exception(Exception, e, e.__traceback__))
+            log.error("%s error with a batch of %d:%s", stage.name, len(batch), batch[:3])
+            log.error("%s", err)
+            self._failed(stage, [args if stage.multi else [args] for args in batch], err)
+
+    def _chunks(self, stage):
+        "chunks of args, block for the first args, then take what's ready"
+        upstream = stage.upstream
+        while True:
+            try:
+                chunk = [self._take(stage)]
+            except Finished:
+                return
+            while len(chunk) < stage.chunk and all(not self.lines[u].empty() for u in upstream):
+                try:
+                    chunk.append(self._take(stage))
+                except Finished:
+                    break
+            yield chunk
+
+    def _process_work(self, stage, stats):
+        # keep two chunks per process in flight, so processes never wait for the feeder
+        name = stage.name
+        downstream = stage.downstream
+        inflight = collections.deque()
+
+        def emit():
+            chunk, keys, result = inflight.popleft()
+            try:
+                results = result.get()
+            except Exception as e:  # noqa
+                # the pool lost the whole chunk, e.g. an output can't be pickled
+                stats.errors += len(chunk)
+                err = "".join(traceback.format_exception(Exception, e, e.__traceback__))
+                log.error("%s error with %d args:%s", name, len(chunk), chunk)
+                log.error("%s", err)
+                self._failed(stage, chunk, err)
+                return
+            for i, (args, (ok, output, cost)) in enumerate(zip(chunk, results)):
+                stats.busy += cost
+                if ok:
+                    stats.latencies.append(cost)
+                    if keys:
+                        self.ledger.done(stage.id, [(keys[i], output)])
+                    stats.items_out += self.put_args(self._make_list(output), downstream)
+                else:
+                    stats.errors += 1
+                    log.error("%s error with args:%s", name, args)
+                    log.error("%s", output)
+                    self._failed(stage, [args], output)
+
+        start = time.perf_counter()
+        for chunk in self._chunks(stage):
+            stats.idle += time.perf_counter() - start
+            stats.items_in += len(chunk)
+            keys = None
+            if self.ledger:
+                chunk, keys = self._skip_done(stage, chunk, stats)
+            if chunk:
+                inflight.append((chunk, keys, stage.pool.apply_async(_run_chunk, (chunk,))))
+            while inflight and (len(inflight) > stage.concurrency * 2 or inflight[0][2].ready()):
+                emit()
+            start = time.perf_counter()
+        while inflight:
+            emit()
+
+
+    def start(self):
+        # fork the pools before any thread starts
+        if "fork" in multiprocessing.get_all_start_methods():
+            ctx = multiprocessing.get_context("fork")
+        else:
+            ctx = multiprocessing.get_context()
+        pooled = [stage for stage in self.stages if stage.executor == "process"]
+        for stage in pooled:
+            stage.pool = ctx.Pool(stage.concurrency, initializer=_init_stage,
+                                  initargs=(stage.do_work, stage.retries, stage.backoff))
+        for name, stage in zip(self._stage_names(), self.stages):
+            stage.id = name
+        if self.checkpoint:
+            self.ledger = Ledger(self.checkpoint)
+        done = threading.Event()
+        try:
+            for w in list(self.workers):
+                w.start()
+            scaled = [stage for stage in self.stages if stage.autoscale]
+            if scaled:
+                threading.Thread(target=self._autoscaler, args=(scaled,), daemon=True).start()
+            threading.Thread(target=self._monitor, args=(done,), daemon=True).start()
+            # autoscaling may add workers while joining
+            i = 0
+            while i < len(self.workers):
+                self.workers[i].join()
+                i += 1
+        finally:
+            done.set()
+            if self.ledger:
+                self.ledger.close()
+                self.ledger = None
+            for stage in pooled:
+                stage.pool.close()
+                stage.pool.join()
+
+
+    def _monitor(self, done):
+        "sample the queue depths, and log a report every `report_interval` seconds"
+        last = time.monotonic()
+        while not done.wait(self.sample_interval):
+            self.sample()
+            if self.report_interval and time.monotonic() - last >= self.report_interval:
+                last = time.monotonic()
+                log.info("flowline report:\n%s", self.report())
+
+    def sample(self):
+        for stage in self.stages:
+            if stage.upstream:
+                stage.depths.append(sum(len(self.lines[u]) for u in stage.upstream))
+
+    def _stage_names(self):
+        "names of the stages, a name resgisted more than once gets #index"
+        names = [stage.name for stage in self.stages]
+        return [n if names.count(n) == 1 else "{}#{}".format(n, i) for i, n in enumerate(names)]
+
+    def snapshot(self):
+        """{"stages": {name: counters}, "lines": line_stats()},
+        counters of a stage:
+        replicas, items_in, items_out, errors,
+        busy, idle: seconds in do_work and waiting for args, summed over replicas,
+        busy_ratio: busy in the time the replicas or the processes lived,
+        latency_ms_p50, latency_ms_p99: of the latest calls of do_work,
+        depth_avg, depth_max: items queued in its upstreams, of the samples."""
+        stages = {}
+        for name, stage in zip(self._stage_names(), self.stages):
+            stages[name] = stage.snapshot()
+        return {"stages": stages, "lines": self.line_stats()}
+
+    def report(self):
+        "snapshot as a table"
+        def fmt(v, spec):
+            return "-" if v is None else format(v, spec)
+        rows = ["{:<20} {:>4} {:>10} {:>10} {:>6} {:>6} {:>9} {:>9} {:>8} {:>8}".format(
+            "stage", "reps", "in", "out", "errors", "busy%", "p50_ms", "p99_ms", "depth", "depth_max")]
+        for name, st in self.snapshot()["stages"].items():
+            rows.append("{:<20} {:>4} {:>10} {:>10} {:>6} {:>6} {:>9} {:>9} {:>8} {:>8}".format(
+                name[:20], st["replicas"], st["items_in"], st["items_out"], st["errors"],
+                fmt(st["busy_ratio"] * 100, ".1f"), fmt(st["latency_ms_p50"], ".3f"),
+                fmt(st["latency_ms_p99"], ".3f"), fmt(st["depth_avg"], ".1f"),
+                fmt(st["depth_max"], "d")))
+        return "\n".join(rows)
+
+    def profile(self, name):
+        "pstats.Stats of a stage resgisted with profile=True, by its name in snapshot()"
+        for n, stage in zip(self._stage_names(), self.stages):
+            if n == name:
+                return stage.profile_stats
+        raise Error("no such stage: {}".format(name))
 
     @staticmethod
     def _make_list(data):
@@ -78,81 +892,309 @@ class FlowLine:
             data = [data]
         return data
 
-    @staticmethod
-    def new_line():
-        return {
-            "producer": 0,
-            "consumer": 0,
-            "queue": queue.Queue()
-        }
+    def new_line(self, name):
+        return Line(self.capacities.get(name, self.capacity))
+
+    def line_stats(self):
+        "{line name: size, capacity, high water mark, times of blocked puts}"
+        return {name: line.stats() for name, line in self.lines.items()}
 
     def recruit_worker(self, worker, upstream, downstream):
-        self.workers.append(worker)
+        if worker:
+            self.workers.append(worker)
         if upstream:
             for u in upstream:
                 if u not in self.lines:
-                    self.lines[u] = self.new_line()
-                self.lines[u]["consumer"] += 1
+                    self.lines[u] = self.new_line(u)
+                line = self.lines[u]
+                if line.inline or (line.consumer and worker is None):
+                    raise Error("line {} with an inline worker can't have other consumers".format(u))
+                line.add_consumer()
         if downstream:
             for d in downstream:
                 if d not in self.lines:
-                    self.lines[d] = self.new_line()
-                self.lines[d]["producer"] += 1
+                    self.lines[d] = self.new_line(d)
+                self.lines[d].add_producer()
 
     def fire_worker(self, downstream):
         if downstream:
             for d in downstream:
                 if d not in self.lines:
-                    self.lines[d] = self.new_line()
-                self.lines[d]["producer"] -= 1
+                    self.lines[d] = self.new_line(d)
+                line = self.lines[d]
+                if line.remove_producer() and line.inline:
+                    line.inline[1]()
 
     def finished(self, upstream):
         if not upstream:
             return True
-        finish = True
-        for u in upstream:
-            line = self.lines[u]
-            if line["producer"] > 0 or not line["queue"].empty():
-                finish = False
-                break
-        return finish
+        return all(self.lines[u].finished() for u in upstream)
 
-    def get_args(self, upstream):
+    def get_args(self, upstream, timeout=None):
+        """take one item from each upstream, blocking until they arrive,
+        raise Finished when any upstream has no more,
+        raise NotReady if the first upstream is empty for `timeout` seconds."""
         if not upstream:
             return []
-        args = []
-        not_ready = False
-        self.lock.acquire()
-        for u in upstream:
-            q = self.lines[u]["queue"]
-            if q.empty():
-                not_ready = True
-                break
+        args = [self.lines[upstream[0]].get(timeout)]
+        for u in upstream[1:]:
+            args.append(self.lines[u].get())
+        return args
+
+    def put_batch(self, outputs, downstream):
+        "put a batch of outputs, each line is locked once, return the items put"
+        if not outputs or not downstream:
+            return 0
+        columns = [[] for _ in downstream]
+        for output in outputs:
+            output = self._make_list(output)
+            if not output:
+                continue
+            if len(output) != len(downstream):
+                log.error("output %s and downstream %s mismatched!", output, downstream)
+                continue
+            for i, o in enumerate(output):
+                if o:
+                    columns[i].append(o)
+        count = 0
+        for d, items in zip(downstream, columns):
+            line = self.lines[d]
+            if not items:
+                continue
+            count += len(items)
+            if line.inline:
+                for item in items:
+                    line.inline[0](item)
             else:
-                args.append(q.get())
-        if not_ready:
-            for i, a in enumerate(args):
-                u = upstream[i]
-                q = self.lines[u]["queue"]
-                q.put(a)
-        self.lock.release()
-        if not_ready:
-            raise NotReady
-        else:
-            return args
+                line.put_many(items)
+        return count
 
     def put_args(self, output, downstream):
+        "return the items put"
         if not output or not downstream:
-            return
+            return 0
         if len(output) != len(downstream):
             log.error("output %s and downstream %s mismatched!", output, downstream)
-            return
+            return 0
+        count = 0
         for i, d in enumerate(downstream):
             if not output[i]:
                 continue
-            q = self.lines[d]["queue"]
-            q.put(output[i])
+            count += 1
+            line = self.lines[d]
+            if line.inline:
+                line.inline[0](output[i])
+            else:
+                line.put(output[i])
+        return count
+
+
+
+class AsyncLine:
+    """a Line for coroutines on one event loop,
+    get and put are awaited instead of blocking a thread."""
 
+    def __init__(self, capacity=0):
+        self.producer = 0
+        self.consumer = 0
+        self.inline = None
+        self.capacity = capacity
+        self.high_water = 0
+        self.blocked = 0
+        self._items = collections.deque()
+        self._getters = collections.deque()
+        self._putters = collections.deque()
+
+    __len__ = Line.__len__
+    empty = Line.empty
+    finished = Line.finished
+    stats = Line.stats
+
+    @staticmethod
+    def _wake(waiters, all=False):
+        while waiters:
+            fut = waiters.popleft()
+            if not fut.done():
+                fut.set_result(None)
+                if not all:
+                    return
+
+    async def _wait(self, waiters):
+        fut = asyncio.get_running_loop().create_future()
+        waiters.append(fut)
+        try:
+            await fut
+        except asyncio.CancelledError:
+            # pass the wakeup on
+            if fut.done() and not fut.cancelled():
+                self._wake(waiters)
+            raise
+
+    async def put(self, item):
+        if self.capacity and len(self._items) >= self.capacity and self.consumer > 0:
+            self.blocked += 1
+            while len(self._items) >= self.capacity and self.consumer > 0:
+                await self._wait(self._putters)
+        self._items.append(item)
+        if len(self._items) > self.high_water:
+            self.high_water = len(self._items)
+        self._wake(self._getters)
+
+    async def get(self):
+        while not self._items:
+            if self.producer <= 0:
+                raise Finished
+            await self._wait(self._getters)
+        item = self._items.popleft()
+        if self.capacity:
+            self._wake(self._putters)
+        if self._items:
+            # a put may have woken a getter that another one beat to it
+            self._wake(self._getters)
+        return item
+
+    def add_consumer(self):
+        self.consumer += 1
+
+    def remove_consumer(self):
+        self.consumer -= 1
+        if self.consumer <= 0:
+            self._wake(self._putters, all=True)
+
+    def add_producer(self):
+        self.producer += 1
+
+    def remove_producer(self):
+        "return True if it's the last producer"
+        self.producer -= 1
+        if self.producer <= 0:
+            self._wake(self._getters, all=True)
+            return True
+        return False
+
+
+class AsyncFlowLine(FlowLine):
+    """a FlowLine of coroutines on one event loop,
+    for io bound works, such as thousands of requests in flight."""
+
+    def __init__(self, **kwargs):
+        "kwargs: capacity, capacities, sample_interval and report_interval, see FlowLine"
+        if kwargs.get("checkpoint"):
+            raise Error("AsyncFlowLine can't checkpoint")
+        super().__init__(**kwargs)
+
+    def resgist(self, do_work, upstream=None, downstream=None, concurrency=1):
+        """resgist a worker with upstream and downstream, like FlowLine,
+        if no upstream, it's a pure producer, and should be an async generator,
+        else it's a coroutine function taking args from upstream,
+        `concurrency` calls of it run at the same time."""
+        upstream = self._make_list(upstream)
+        downstream = self._make_list(downstream)
+        name = do_work.__name__
+        if not upstream and not inspect.isasyncgenfunction(do_work):
+            raise Error("producer {} should be an async generator".format(name))
+        if upstream and not inspect.iscoroutinefunction(do_work):
+            raise Error("worker {} should be a coroutine function".format(name))
+        stage = Stage(do_work, upstream, downstream, executor="async", concurrency=concurrency or 1)
+        stage.join_lock = asyncio.Lock()
+        self.stages.append(stage)
+        for _ in range(stage.concurrency):
+            stage.replicas += 1
+            self.recruit_worker(stage, upstream, downstream)
+
+    async def _replica(self, stage):
+        log.info("worker %s start to work", stage.name)
+        stats = stage.new_stats()
+        try:
+            if not stage.upstream:
+                start = time.perf_counter()
+                async for output in stage.do_work():
+                    stats.busy += time.perf_counter() - start
+                    stats.items_out += await self.put_args(self._make_list(output), stage.downstream)
+                    start = time.perf_counter()
+            else:
+                while True:
+                    start = time.perf_counter()
+                    try:
+                        if len(stage.upstream) > 1:
+                            async with stage.join_lock:
+                                args = await self.get_args(stage.upstream)
+                        else:
+                            args = await self.get_args(stage.upstream)
+                    except Finished:
+                        break
+                    finally:
+                        stats.idle += time.perf_counter() - start
+                    await self._work(stage.do_work, args, stage.downstream, stats)
+        finally:
+            stats.stopped = time.perf_counter()
+            stage.replicas -= 1
+            self.fire_worker(stage.downstream)
+            for u in stage.upstream:
+                self.lines[u].remove_consumer()
+        log.info("job of worker %s is done", stage.name)
+
+    async def _work(self, do_work, args, downstream, stats):
+        stats.items_in += 1
+        start = time.perf_counter()
+        try:
+            output = await do_work(*args)
+        except Exception as e:  # noqa
+            stats.errors += 1
+            err = traceback.format_exception(Exception, e, e.__traceback__)
+            log.error("%s error with args:%s", do_work.__name__, args)
+            log.error("%s", "".join(err))
+            return
+        cost = time.perf_counter() - start
+        stats.busy += cost
+        stats.latencies.append(cost)
+        stats.items_out += await self.put_args(self._make_list(output), downstream)
+
+    async def run(self):
+        "run in the current event loop until all the workers are done"
+        tasks = [asyncio.ensure_future(self._replica(stage)) for stage in self.workers]
+        monitor = asyncio.ensure_future(self._monitor())
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            monitor.cancel()
+            for task in tasks:
+                task.cancel()
+
+    async def _monitor(self):
+        last = time.monotonic()
+        while True:
+            await asyncio.sleep(self.sample_interval)
+            self.sample()
+            if self.report_interval and time.monotonic() - last >= self.report_interval:
+                last = time.monotonic()
+                log.info("flowline report:\n%s", self.report())
+
+    def start(self):
+        asyncio.run(self.run())
+
+    def new_line(self, name):
+        return AsyncLine(self.capacities.get(name, self.capacity))
+
+    async def get_args(self, upstream):
+        "take one item from each upstream, raise Finished when any upstream has no more"
+        if not upstream:
+            return []
+        return [await self.lines[u].get() for u in upstream]
+
+    async def put_args(self, output, downstream):
+        "return the items put"
+        if not output or not downstream:
+            return 0
+        if len(output) != len(downstream):
+            log.error("output %s and downstream %s mismatched!", output, downstream)
+            return 0
+        count = 0
+        for i, d in enumerate(downstream):
+            if output[i]:
+                count += 1
+                await self.lines[d].put(output[i])
+        return count
 
 
 def example_3xplus1():
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import subprocess
+import time
+
+from flowline import FlowLine
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+class Item:
+    "what flows in the lines, with its birth time"
+    __slots__ = ("t", "n", "data")
+
+    def __init__(self, n, data):
+        self.t = time.perf_counter()
+        self.n = n
+        self.data = data
+
+
+def percentiles(samples):
+    if not samples:
+        return {"p50": None, "p90": None, "p99": None}
+    ss = sorted(samples)
+    return {
+        "p50": ss[len(ss) // 2] * 1000,
+        "p90": ss[min(len(ss) - 1, len(ss) * 90 // 100)] * 1000,
+        "p99": ss[min(len(ss) - 1, len(ss) * 99 // 100)] * 1000,
+    }
+
+
+def spin(n):
+    "pure python cpu work"
+    s = 0
+    for i in range(n):
+        s += i * i
+    return s
+
+
+def producer_of(items, size, interval):
+    data = b"x" * size
+
+    def producer():
+        for n in range(1, items + 1):
+            if interval:
+                time.sleep(interval)
+            yield Item(n, data)
+    return producer
+
+
+def worker_of(cost):
+    def work(item):
+        if cost:
+            spin(cost)
+        return item
+    return work
+
+
+def linear(fl, items, size, cost, interval, sink, stages=4):
+    "a producer, `stages` workers in a line, a sink"
+    fl.resgist(producer_of(items, size, interval), downstream="s0")
+    for i in range(stages):
+        fl.resgist(worker_of(cost), upstream="s{}".format(i), downstream="s{}".format(i + 1))
+    fl.resgist(sink, upstream="s{}".format(stages))
+    return items
+
+
+def fanout(fl, items, size, cost, interval, sink, ways=3):
+    "every item is put into `ways` lines, each with a worker and a sink"
+    lines = ["o{}".format(i) for i in range(ways)]
+
+    def split(item):
+        return tuple(item for _ in lines)
+
+    fl.resgist(producer_of(items, size, interval), downstream="in")
+    fl.resgist(split, upstream="in", downstream=lines)
+    for line in lines:
+        fl.resgist(worker_of(cost), upstream=line, downstream=line + ".out")
+        fl.resgist(sink, upstream=line + ".out")
+    return items * ways
+
+
+def fanin(fl, items, size, cost, interval, sink, join_key=None):
+    "two producers, a worker joining an item of each, a sink"
+    work = worker_of(cost)
+
+    def join(a, b):
+        work(a)
+        # the older one, so latency covers the wait for the other
+        return a if a.t < b.t else b
+
+    fl.resgist(producer_of(items, size, interval), downstream="a")
+    fl.resgist(producer_of(items, size, interval), downstream="b")
+    fl.resgist(join, upstream=["a", "b"], downstream="joined", join_key=join_key)
+    fl.resgist(sink, upstream="joined")
+    return items
+
+
+def keyed_fanin(fl, items, size, cost, interval, sink):
+    "fanin, items are matched by their numbers"
+    return fanin(fl, items, size, cost, interval, sink, join_key=lambda item: item.n)
+
+
+def dispatch(fl, items, size, cost, interval, sink):
+    "the topology of example_3xplus1, one step of it for every item"
+    work = worker_of(cost)
+
+    def route(item):
+        if item.n % 2 == 1:
+            return item, None
+        return None, item
+
+    fl.resgist(producer_of(items, size, interval), downstream="data")
+    fl.resgist(route, upstream="data", downstream=["odd", "even"])
+    fl.resgist(work, upstream="odd", downstream="print")
+    fl.resgist(work, upstream="even", downstream="print")
+    fl.resgist(sink, upstream="print")
+    return items
+
+
+TOPOLOGIES = {
+    "linear": linear,
+    "fanout": fanout,
+    "fanin": fanin,
+    "keyed_fanin": keyed_fanin,
+    "dispatch": dispatch,
+}
+
+
+def bench_topology(topology, items, size, cost, interval=0.0):
+    """run a topology, every item carries its birth time, the sinks record
+    latency, items_per_sec counts the items reaching the sinks."""
+    latencies = []
+
+    def sink(item):
+        latencies.append(time.perf_counter() - item.t)
+
+    fl = FlowLine()
+    expected = TOPOLOGIES[topology](fl, items, size, cost, interval, sink)
+    start = time.perf_counter()
+    fl.start()
+    cost = time.perf_counter() - start
+    assert len(latencies) == expected, (len(latencies), expected)
+
+    result = {"items_per_sec": expected / cost}
+    result.update({"latency_ms_" + k: v for k, v in percentiles(latencies).items()})
+    return result
+
+
+def bench_batch(stages, items, batch):
+    "the linear chain with `batch` items per call, producer included"
+    count = [0]
+
+    def producer():
+        for i in range(0, items, batch):
+            yield [i + 1] * min(batch, items - i)
+
+    def passing(ts):
+        return ts
+
+    def sink(ts):
+        count[0] += len(ts)
+        return ()
+
+    fl = FlowLine()
+    fl.resgist(producer, downstream="s0", batch=batch)
+    for i in range(stages):
+        fl.resgist(passing, upstream="s{}".format(i), downstream="s{}".format(i + 1), batch=batch)
+    fl.resgist(sink, upstream="s{}".format(stages), batch=batch)
+    start = time.perf_counter()
+    fl.start()
+    cost = time.perf_counter() - start
+    assert count[0] == items
+    return {"items_per_sec": items / cost}
+
+
+def bench_cpu(executor, items, work):
+    "a cpu bound stage run by `executor`"
+    count = [0]
+
+    def producer():
+        for _ in range(items):
+            yield work
+
+    def sink(_):
+        count[0] += 1
+
+    fl = FlowLine()
+    fl.resgist(producer, downstream="in")
+    fl.resgist(spin, upstream="in", downstream="out", executor=executor)
+    fl.resgist(sink, upstream="out")
+    start = time.perf_counter()
+    fl.start()
+    cost = time.perf_counter() - start
+    assert count[0] == items
+    return {"items_per_sec": items / cost}
+
+
+def run(args):
+    results = {}
+    for topology in args.topologies:
+        for size in args.sizes:
+            for cost in args.costs:
+                name = "{}.size{}.cost{}".format(topology, size, cost)
+                results[name + ".flood"] = bench_topology(topology, args.items, size, cost)
+                if args.paced_items:
+                    results[name + ".paced"] = bench_topology(
+                        topology, args.paced_items, size, cost, args.interval)
+    if args.batch:
+        results["linear.batch{}".format(args.batch)] = bench_batch(4, args.items, args.batch)
+    if args.cpu_items:
+        for executor in ("thread", "process"):
+            results["cpu." + executor] = bench_cpu(executor, args.cpu_items, args.cpu_work)
+    return results
+
+
+def revision():
+    try:
+        out = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=HERE,
+                                      stderr=subprocess.DEVNULL)
+        return out.decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report(results, baseline=None):
+    base = baseline["results"] if baseline else {}
+    for name, result in results.items():
+        for key, value in result.items():
+            if value is None:
+                continue
+            line = "{:<36} {:<18} {:>14.3f}".format(name, key, value)
+            old = base.get(name, {}).get(key)
+            if old:
+                line += "  {:>+8.1f}%".format((value - old) / old * 100)
+            print(line)
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="benchmark of flowline.py")
+    parser.add_argument("--topologies", nargs="+", default=list(TOPOLOGIES), choices=list(TOPOLOGIES))
+    parser.add_argument("--sizes", nargs="+", type=int, default=[16, 16384],
+                        help="bytes carried by every item")
+    parser.add_argument("--costs", nargs="+", type=int, default=[0, 2000],
+                        help="loops of cpu work of every worker per item")
+    parser.add_argument("--items", type=int, default=20000, help="items of the flood tests")
+    parser.add_argument("--paced-items", type=int, default=200,
+                        help="items of the paced latency tests, 0 to skip them")
+    parser.add_argument("--interval", type=float, default=0.005,
+                        help="seconds between items of the paced tests")
+    parser.add_argument("--batch", type=int, default=256, help="items per call of the batch test, 0 to skip")
+    parser.add_argument("--cpu-items", type=int, default=2000, help="items of the cpu tests, 0 to skip")
+    parser.add_argument("--cpu-work", type=int, default=20000, help="loops of every cpu item")
+    parser.add_argument("--output", help="save the results into this json file")
+    parser.add_argument("--compare", help="json file of an earlier run to compare with")
+    args = parser.parse_args(argv)
+
+    results = run(args)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)
+    report(results, baseline)
+    if args.output:
+        params = {k: v for k, v in vars(args).items() if k not in ("output", "compare")}
+        with open(args.output, "w") as fp:
+            json.dump({"revision": revision(), "time": time.time(), "params": params,
+                       "results": results}, fp, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,14 +2,466 @@
 # coding: utf-8
 
 import asyncio
+import collections
+import errno
+import ipaddress
+import json
 import logging
+import os
+import signal
 import socket
+import time
+import traceback
 
 
 log = logging.getLogger("lightproxy")
 
 
-class LightProxyProtocol(asyncio.Protocol):
+class DNSCache:
+    """an in-process cache in front of loop.getaddrinfo.
+    results are kept for `ttl` seconds and failures for `negative_ttl` seconds,
+    at most `maxsize` hosts are kept and the least recently used is evicted,
+    concurrent lookups of one host share a single getaddrinfo call.
+    one instance should be shared by all connections of a loop."""
+
+    TTL = 60
+    NEGATIVE_TTL = 5
+    MAXSIZE = 4096
+
+    def __init__(self, loop, **kwargs):
+        self._loop = loop
+        self.ttl = kwargs.get("ttl", self.TTL)
+        self.negative_ttl = kwargs.get("negative_ttl", self.NEGATIVE_TTL)
+        self.maxsize = kwargs.get("maxsize", self.MAXSIZE)
+        self._cache = collections.OrderedDict()  # host -> (expire, infos, exception)
+        self._inflight = {}
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def stats(self):
+        return {
+            "size": len(self._cache),
+            "inflight": len(self._inflight),
+            "hits": self.hits,
+            "negative_hits": self.negative_hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+        }
+
+    def resolve(self, host, port):
+        "return a future of getaddrinfo(host, port, type=SOCK_STREAM)"
+        futu = self._loop.create_future()
+        infos = self._literal(host)
+        if infos:
+            futu.set_result(self._with_port(infos, port))
+            return futu
+
+        item = self._cache.get(host)
+        if item and item[0] > self._loop.time():
+            self._cache.move_to_end(host)
+            if item[2] is not None:
+                self.negative_hits += 1
+                exc = item[2]
+                futu.set_exception(type(exc)(*exc.args))
+            else:
+                self.hits += 1
+                futu.set_result(self._with_port(item[1], port))
+            return futu
+
+        lookup = self._inflight.get(host)
+        if lookup:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            coro = self._loop.getaddrinfo(host, 0, type=socket.SOCK_STREAM)
+            lookup = asyncio.ensure_future(coro)
+            lookup.add_done_callback(lambda f: self._lookup_done(host, f))
+            self._inflight[host] = lookup
+        lookup.add_done_callback(lambda f: self._deliver(futu, f, port))
+        return futu
+
+    def _lookup_done(self, host, lookup):
+        del self._inflight[host]
+        if lookup.cancelled():
+            return
+        exc = lookup.exception()
+        if exc is not None:
+            item = (self._loop.time() + self.negative_ttl, None, exc)
+        else:
+            item = (self._loop.time() + self.ttl, lookup.result(), None)
+        self._cache[host] = item
+        self._cache.move_to_end(host)
+        while len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+
+    def _deliver(self, futu, lookup, port):
+        if futu.done():
+            return
+        if lookup.cancelled():
+            futu.cancel()
+        elif lookup.exception() is not None:
+            futu.set_exception(lookup.exception())
+        else:
+            futu.set_result(self._with_port(lookup.result(), port))
+
+    @staticmethod
+    def _literal(host):
+        try:
+            ip = ipaddress.ip_address(host)
+        except ValueError:
+            return None
+        if ip.version == 4:
+            return [(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP, "", (host, 0))]
+        return [(socket.AF_INET6, socket.SOCK_STREAM, socket.IPPROTO_TCP, "", (host, 0, 0, 0))]
+
+    @staticmethod
+    def _with_port(infos, port):
+        return [(f, t, p, c, (sa[0], port) + tuple(sa[2:])) for f, t, p, c, sa in infos]
+
+
+HAPPY_EYEBALLS_DELAY = 0.25
+
+
+class ProxyStats:
+    """in-memory counters of a proxy loop, cheap enough for the hot path:
+    plain integer adds per chunk, latencies kept in fixed size reservoirs,
+    destinations counted and trimmed to the most common when too many."""
+
+    SAMPLES = 1024
+    MAX_DESTINATIONS = 10000
+
+    def __init__(self, resolver=None):
+        self.resolver = resolver
+        self.active = 0
+        self.connections = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.connect_failures = 0
+        self.udp_associations = 0
+        self.timeouts = 0
+        self.throttled = 0
+        self.handshake_latency = collections.deque(maxlen=self.SAMPLES)
+        self.dns_latency = collections.deque(maxlen=self.SAMPLES)
+        self.destinations = collections.Counter()
+
+    def add_destination(self, host):
+        self.destinations[host] += 1
+        if len(self.destinations) > self.MAX_DESTINATIONS:
+            self.destinations = collections.Counter(
+                dict(self.destinations.most_common(self.MAX_DESTINATIONS // 2)))
+
+    @staticmethod
+    def _percentiles(samples):
+        if not samples:
+            return {"p50": None, "p99": None, "count": 0}
+        ss = sorted(samples)
+        return {
+            "p50": ss[len(ss) // 2],
+            "p99": ss[min(len(ss) - 1, len(ss) * 99 // 100)],
+            "count": len(ss),
+        }
+
+    def snapshot(self, top=10):
+        return {
+            "active": self.active,
+            "connections": self.connections,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "connect_failures": self.connect_failures,
+            "udp_associations": self.udp_associations,
+            "timeouts": self.timeouts,
+            "throttled": self.throttled,
+            "handshake_latency": self._percentiles(self.handshake_latency),
+            "dns_latency": self._percentiles(self.dns_latency),
+            "top_destinations": self.destinations.most_common(top),
+            "dns_cache": self.resolver.stats() if self.resolver else None,
+        }
+
+
+async def serve_stats(stats, host, port):
+    "serve stats.snapshot() as json on a local http port"
+    async def handle(reader, writer):
+        try:
+            await reader.readuntil(b"\r\n\r\n")
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            writer.close()
+            return
+        body = json.dumps(stats.snapshot(), indent=2).encode("utf-8")
+        writer.write(b"HTTP/1.0 200 OK\r\nContent-Type: application/json\r\n"
+                     b"Content-Length: " + str(len(body)).encode("ascii") + b"\r\n\r\n" + body)
+        await writer.drain()
+        writer.close()
+
+    return await asyncio.start_server(handle, host, port)
+
+
+def _interleave(infos):
+    "reorder addrinfos to alternate between address families, keeping the first family first"
+    families = collections.OrderedDict()
+    for info in infos:
+        families.setdefault(info[0], collections.deque()).append(info)
+    queues = list(families.values())
+    result = []
+    while queues:
+        for q in queues:
+            result.append(q.popleft())
+        queues = [q for q in queues if q]
+    return result
+
+
+async def _connect_one(loop, info):
+    sock = socket.socket(info[0], info[1], info[2])
+    try:
+        sock.setblocking(False)
+        await loop.sock_connect(sock, info[-1])
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+
+async def happy_connect(loop, infos, delay=HAPPY_EYEBALLS_DELAY):
+    """race connections to addrinfos from getaddrinfo (rfc 8305 happy eyeballs),
+    the next attempt starts `delay` seconds after the previous one
+    or as soon as it fails, return the socket connected first."""
+    infos = iter(_interleave(infos))
+    pending = set()
+    errors = []
+    winner = None
+    try:
+        while winner is None:
+            info = next(infos, None)
+            if info is not None:
+                pending.add(asyncio.ensure_future(_connect_one(loop, info)))
+            elif not pending:
+                break
+            timeout = delay if info is not None else None
+            done, pending = await asyncio.wait(pending, timeout=timeout,
+                                               return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is not None:
+                    errors.append(task.exception())
+                elif winner is None:
+                    winner = task.result()
+                else:
+                    task.result().close()
+    finally:
+        for task in pending:
+            task.cancel()
+
+    if winner is None:
+        if len(errors) == 1:
+            raise errors[0]
+        raise OSError("multiple exceptions: {}".format(", ".join(str(e) for e in errors)))
+    return winner
+
+
+class UpstreamProtocol(asyncio.BufferedProtocol):
+    """the upstream side of a relay,
+    reads into a preallocated buffer and writes it to the client directly."""
+
+    def __init__(self, client):
+        self._client = client
+        self._transport = None
+        self._buffer = bytearray(client.BUFFER_SIZE)
+        self._view = memoryview(self._buffer)
+        self.stalled_since = None
+
+    def connection_made(self, transport):
+        self._transport = transport
+        self._transport.set_write_buffer_limits(self._client.high_water, self._client.low_water)
+        self._client.upstream_made(transport)
+
+    def connection_lost(self, exc):
+        self._client.upstream_lost(exc)
+
+    def pause_writing(self):
+        # upstream is slower than client
+        self.stalled_since = self._client.last_active
+        self._client.transport.pause_reading()
+
+    def resume_writing(self):
+        self.stalled_since = None
+        self._client.transport.resume_reading()
+
+    def get_buffer(self, sizehint):
+        return self._view
+
+    def buffer_updated(self, nbytes):
+        self._client.stats.bytes_out += nbytes
+        self._client.touch()
+        transport = self._client.transport
+        transport.write(self._view[:nbytes])
+        if transport.get_write_buffer_size():
+            # the transport may keep a reference to our buffer, don't reuse it
+            self._buffer = bytearray(len(self._buffer))
+            self._view = memoryview(self._buffer)
+
+    def eof_received(self):
+        return self._client.upstream_eof()
+
+
+class UDPRelayProtocol(asyncio.DatagramProtocol):
+    """relay of one socks5 UDP association.
+    datagrams from the client carry the socks5 UDP header and are sent on
+    to their destination, which is remembered in a NAT table, datagrams
+    from a remembered destination get the header back and go to the client.
+    NAT entries idle for `timeout` seconds are dropped,
+    headers are built once per destination instead of once per packet."""
+
+    TIMEOUT = 60
+
+    def __init__(self, loop, client_addr, resolver, **kwargs):
+        self._loop = loop
+        self._client_host, self._client_port = client_addr
+        self._client_addr = None
+        self._resolver = resolver
+        self.timeout = kwargs.get("timeout", self.TIMEOUT)
+        self._transport = None
+        self._nat = {}  # remote sockaddr -> [reply header, tick]
+        self._dests = {}  # request header -> remote sockaddr
+        self._last_header = None
+        self._last_dest = None
+        self._tick = 0
+        self._sweeper = None
+        self.packets_in = 0
+        self.packets_out = 0
+
+    def connection_made(self, transport):
+        self._transport = transport
+        self._sweeper = self._loop.call_later(self.timeout / 2, self._sweep)
+
+    def connection_lost(self, exc):
+        if self._sweeper:
+            self._sweeper.cancel()
+
+    def close(self):
+        self._transport.close()
+
+    def _sweep(self):
+        # an entry is idle when it's not seen in the last two sweeps
+        self._tick += 1
+        expired = [addr for addr, entry in self._nat.items() if entry[1] < self._tick - 1]
+        for addr in expired:
+            del self._nat[addr]
+        if expired:
+            self._dests.clear()
+            self._last_header = None
+        self._sweeper = self._loop.call_later(self.timeout / 2, self._sweep)
+
+    def datagram_received(self, data, addr):
+        entry = self._nat.get(addr)
+        if entry is not None:
+            # from a remote
+            entry[1] = self._tick
+            if self._client_addr:
+                self.packets_out += 1
+                self._transport.sendto(entry[0] + data, self._client_addr)
+        elif addr == self._client_addr:
+            self._from_client(data)
+        elif self._client_addr is None and addr[0] == self._client_host \
+                and (not self._client_port or addr[1] == self._client_port):
+            self._client_addr = addr
+            self._from_client(data)
+
+    def _from_client(self, data):
+        view = memoryview(data)
+        n = self._header_size(view)
+        if n == 0 or view[2] != 0:
+            # bad header or fragmented, which is not supported
+            return
+        self.packets_in += 1
+        if self._last_header is not None and view[:n] == self._last_header:
+            self._send(view[n:], self._last_dest)
+            return
+        header = bytes(view[:n])
+        dest = self._dests.get(header)
+        if dest is not None:
+            self._remember(header, dest)
+            self._send(view[n:], dest)
+            return
+
+        atype = header[3]
+        port = int.from_bytes(header[-2:], "big")
+        if atype == LightProxyProtocol.ATYPE_IPV4:
+            host = socket.inet_ntop(socket.AF_INET, header[4:8])
+        elif atype == LightProxyProtocol.ATYPE_IPV6:
+            host = socket.inet_ntop(socket.AF_INET6, header[4:20])
+        else:
+            host = header[5:-2].decode("utf-8", "replace")
+        futu = self._resolver.resolve(host, port)
+        payload = view[n:]
+        if futu.done():
+            self._resolved(header, payload, futu)
+        else:
+            payload = bytes(payload)
+            futu.add_done_callback(lambda f: self._resolved(header, payload, f))
+
+    def _resolved(self, header, payload, futu):
+        if futu.cancelled() or futu.exception() or self._transport.is_closing():
+            return
+        family = self._transport.get_extra_info("socket").family
+        for info in futu.result():
+            if info[0] == family:
+                dest = info[-1]
+                break
+        else:
+            return
+        if dest not in self._nat:
+            self._nat[dest] = [self._reply_header(dest), self._tick]
+        self._dests[header] = dest
+        self._remember(header, dest)
+        self._send(payload, dest)
+
+    def _remember(self, header, dest):
+        self._last_header = header
+        self._last_dest = dest
+
+    def _send(self, payload, dest):
+        entry = self._nat.get(dest)
+        if entry is None:
+            # expired
+            entry = self._nat[dest] = [self._reply_header(dest), self._tick]
+        entry[1] = self._tick
+        self._transport.sendto(payload, dest)
+
+    @staticmethod
+    def _header_size(view):
+        "size of RSV FRAG ATYP DST.ADDR DST.PORT, 0 if invalid"
+        if len(view) < 4:
+            return 0
+        atype = view[3]
+        if atype == LightProxyProtocol.ATYPE_IPV4:
+            n = 10
+        elif atype == LightProxyProtocol.ATYPE_IPV6:
+            n = 22
+        elif atype == LightProxyProtocol.ATYPE_DOMN and len(view) > 4:
+            n = 7 + view[4]
+        else:
+            return 0
+        return n if len(view) >= n else 0
+
+    @staticmethod
+    def _reply_header(addr):
+        if ":" in addr[0]:
+            bb = b"\x04" + socket.inet_pton(socket.AF_INET6, addr[0])
+        else:
+            bb = b"\x01" + socket.inet_pton(socket.AF_INET, addr[0])
+        return b"\x00\x00\x00" + bb + addr[1].to_bytes(2, "big")
+
+
+class LightProxyProtocol(asyncio.BufferedProtocol):
+    """socks5 proxy for one client connection.
+    both directions are flow controlled: when one side's write buffer grows
+    over `high_water`, reading from the other side is paused until it drains
+    under `low_water`, so a connection holds at most about
+    2 * (high_water + BUFFER_SIZE) bytes whatever the speeds are."""
+
+    BUFFER_SIZE = 64 * 1024
+    HIGH_WATER = 256 * 1024
+    LOW_WATER = 64 * 1024
 
     CMD_CONN = 1
     CMD_BIND = 2
@@ -19,110 +471,374 @@ class LightProxyProtocol(asyncio.Protocol):
     ATYPE_DOMN = 3
     ATYPE_IPV6 = 4
 
-    def __init__(self, loop):
+    STAGE_GREETING = 0
+    STAGE_REQUEST = 1
+    STAGE_CONNECTING = 2
+    STAGE_STREAM = 3
+    STAGE_UDP = 4
+
+    REP_SUCCEEDED = 0
+    REP_FAILURE = 1
+    REP_NETWORK_UNREACHABLE = 3
+    REP_HOST_UNREACHABLE = 4
+    REP_REFUSED = 5
+    REP_TTL_EXPIRED = 6
+    REP_CMD_UNSUPPORTED = 7
+    REP_ATYPE_UNSUPPORTED = 8
+
+    LOG_SAMPLE = 100
+    HANDSHAKE_TIMEOUT = 10
+    CONNECT_TIMEOUT = 10
+    IDLE_TIMEOUT = 300
+    STALL_TIMEOUT = 60
+
+    def __init__(self, loop, **kwargs):
         self._loop = loop
+        self.high_water = kwargs.get("high_water", self.HIGH_WATER)
+        self.low_water = kwargs.get("low_water", self.LOW_WATER)
+        self._resolver = kwargs.get("resolver") or DNSCache(loop)
+        self.stats = kwargs.get("stats") or ProxyStats()
+        self.log_sample = kwargs.get("log_sample", self.LOG_SAMPLE)
+        self.handshake_timeout = kwargs.get("handshake_timeout", self.HANDSHAKE_TIMEOUT)
+        self.connect_timeout = kwargs.get("connect_timeout", self.CONNECT_TIMEOUT)
+        self.idle_timeout = kwargs.get("idle_timeout", self.IDLE_TIMEOUT)
+        self.stall_timeout = kwargs.get("stall_timeout", self.STALL_TIMEOUT)
+        self.happy_eyeballs_delay = kwargs.get("happy_eyeballs_delay", HAPPY_EYEBALLS_DELAY)
+        self.udp_timeout = kwargs.get("udp_timeout", UDPRelayProtocol.TIMEOUT)
+        self._server = kwargs.get("server")
         self._transport = None
+        self._udp = None
+        self._sampled = False
+        self._started = None
+        self._dns_started = None
+        self._upstream_protocol = None
+        self._stalled_since = None
+        self.last_active = None
         self._peername = None
         self._socket = None
         self._stage = None
-        self._con_data = None
         self._futures = []
+        self._upstream = None
+        self._eofs = 0
+        # handshake bytes not parsed yet, then data pipelined before the upstream is ready
+        self._inbuf = bytearray()
+        self._buffer = bytearray(self.BUFFER_SIZE)
+        self._view = memoryview(self._buffer)
+
+    @property
+    def transport(self):
+        return self._transport
 
 
     def connection_made(self, transport):
         self._transport = transport
+        self._transport.set_write_buffer_limits(self.high_water, self.low_water)
         self._peername = self._transport.get_extra_info('peername')
-        log.info("connected from %s", self._peername)
-        self._stage = 0
+        self._started = self.last_active = self._loop.time()
+        self.stats.active += 1
+        self.stats.connections += 1
+        # per connection logs of only one in `log_sample` connections
+        self._sampled = self.stats.connections % self.log_sample == 0
+        self._log(logging.INFO, "connected from %s", self._peername)
+        self._stage = self.STAGE_GREETING
+        if self._server:
+            self._server.connections.add(self)
 
     def connection_lost(self, exc):
-        log.info("disconneted from %s", self._peername)
-        if self._socket:
-            self._loop.remove_reader(self._socket)
+        self._log(logging.INFO, "disconneted from %s", self._peername)
+        self.stats.active -= 1
+        if self._server:
+            self._server.release(self)
+        if self._upstream:
+            self._upstream.close()
+        elif self._socket:
             self._socket.close()
+        if self._udp:
+            self._udp.close()
         for futu in self._futures:
             futu.cancel()
 
+    def close(self):
+        self._transport.abort()
+
+    def touch(self):
+        self.last_active = self._loop.time()
+
+    def check_timeouts(self, now):
+        "evict the connection when it's stuck, called periodically by the server"
+        if self._stage in (self.STAGE_GREETING, self.STAGE_REQUEST):
+            expired = now - self._started > self.handshake_timeout
+        elif self._stage == self.STAGE_CONNECTING:
+            if now - self.last_active > self.connect_timeout:
+                self._log(logging.WARNING, "connect timeout")
+                self.stats.timeouts += 1
+                self._reply_error(self.REP_TTL_EXPIRED)
+            return
+        elif self._stage == self.STAGE_STREAM:
+            stalled = self._stalled_since
+            if self._upstream_protocol and self._upstream_protocol.stalled_since is not None:
+                stalled = min(stalled or now, self._upstream_protocol.stalled_since)
+            expired = now - self.last_active > self.idle_timeout or \
+                (stalled is not None and now - stalled > self.stall_timeout)
+        else:
+            return
+        if expired:
+            self._log(logging.WARNING, "evict %s at stage %d", self._peername, self._stage)
+            self.stats.timeouts += 1
+            self.close()
+
+    def _log(self, level, msg, *args):
+        if self._sampled:
+            log.log(level, msg, *args)
 
-    def data_received(self, data: bytes):
-        if self._stage == 0:
-            self._stage = 1
-            self._handle_authorised(data)
-        elif self._stage == 1:
-            self._stage = 2
-            self._handle_connect(data)
-        elif self._stage == 2:
-            self._handle_stream(data)
+    def upstream_made(self, transport):
+        # called before any upstream data, so the reply goes first
+        self._upstream = transport
+        self._stage = self.STAGE_STREAM
+        self._reply(self.REP_SUCCEEDED, transport.get_extra_info("sockname"))
+        self.stats.handshake_latency.append(self._loop.time() - self._started)
+        if self._inbuf:
+            # pipelined with the handshake, not counted by buffer_updated
+            self.stats.bytes_in += len(self._inbuf)
+            self._upstream.write(self._inbuf)
+            self._inbuf = bytearray()
+            self._transport.resume_reading()
+
+    def upstream_lost(self, exc):
+        self._transport.close()
+
+    def eof_received(self):
+        # half close, pass the eof on and keep reading from upstream
+        self._eofs += 1
+        if not self._upstream or self._eofs == 2:
+            return False
+        self._upstream.write_eof()
+        return True
+
+    def upstream_eof(self):
+        self._eofs += 1
+        if self._eofs == 2:
+            self._transport.close()
+            return False
+        self._transport.write_eof()
+        return True
+
+    def pause_writing(self):
+        # client is slower than upstream
+        self._stalled_since = self._loop.time()
+        if self._upstream:
+            self._upstream.pause_reading()
+
+    def resume_writing(self):
+        self._stalled_since = None
+        if self._upstream:
+            self._upstream.resume_reading()
+
+
+    def get_buffer(self, sizehint):
+        return self._view
+
+    def buffer_updated(self, nbytes):
+        self.last_active = self._loop.time()
+        if self._upstream:
+            self.stats.bytes_in += nbytes
+            self._upstream.write(self._view[:nbytes])
+            if self._upstream.get_write_buffer_size():
+                # the transport may keep a reference to our buffer, don't reuse it
+                self._buffer = bytearray(len(self._buffer))
+                self._view = memoryview(self._buffer)
         else:
-            log.error("stage error")
+            self._inbuf += self._view[:nbytes]
+            self._parse()
 
+    def _parse(self):
+        "parse as many handshake messages as buffered, they may be split or coalesced"
+        while self._inbuf:
+            if self._stage == self.STAGE_GREETING:
+                n = self._handle_greeting(self._inbuf)
+            elif self._stage == self.STAGE_REQUEST:
+                n = self._handle_request(self._inbuf)
+            elif self._stage == self.STAGE_UDP:
+                # the control connection carries nothing more
+                self._inbuf.clear()
+                break
+            else:
+                # pipelined data, kept until the upstream is ready
+                if len(self._inbuf) >= self.high_water:
+                    self._transport.pause_reading()
+                break
+            if n == 0:
+                break
+            del self._inbuf[:n]
 
-    def _handle_authorised(self, data: bytes):
-        self._transport.write(b"\x05\x00")
 
-    def _handle_connect(self, data: bytes):
+    def _handle_greeting(self, data: bytearray):
+        "VER NMETHODS METHODS, return the bytes consumed or 0 if incomplete"
+        if len(data) < 2:
+            return 0
+        if data[0] != 5:
+            self._log(logging.ERROR, "bad version: %d", data[0])
+            self._transport.abort()
+            return 0
+        n = 2 + data[1]
+        if len(data) < n:
+            return 0
+        if 0 in data[2:n]:
+            self._transport.write(b"\x05\x00")
+            self._stage = self.STAGE_REQUEST
+        else:
+            self._log(logging.ERROR, "no acceptable methods")
+            self._transport.write(b"\x05\xff")
+            self._transport.close()
+            return 0
+        return n
+
+    def _handle_request(self, data: bytearray):
+        "VER CMD RSV ATYP DST.ADDR DST.PORT, return the bytes consumed or 0 if incomplete"
+        if len(data) < 5:
+            return 0
+        cmd = data[1]
         atype = data[3]
-        addr = data[4:-2]
-        port = data[-2:]
-        self._con_data = data
-        if atype == self.ATYPE_IPV4 or atype == self.ATYPE_IPV6:
-            host = addr.decode("ascii")
+        if atype == self.ATYPE_IPV4:
+            start, end = 4, 8
+        elif atype == self.ATYPE_IPV6:
+            start, end = 4, 20
         elif atype == self.ATYPE_DOMN:
-            host = addr[1:].decode("utf-8")
+            start, end = 5, 5 + data[4]
         else:
-            log.error("no such atype: %d", atype)
-            return
+            self._log(logging.ERROR, "no such atype: %d", atype)
+            self._reply_error(self.REP_ATYPE_UNSUPPORTED)
+            return 0
+        if len(data) < end + 2:
+            return 0
 
-        port = self._port_b2i(port)
-        log.info("%s:%d", host, port)
-        coro = self._loop.getaddrinfo(host, port)
-        futu = asyncio.ensure_future(coro)
+        if atype == self.ATYPE_IPV4:
+            host = socket.inet_ntop(socket.AF_INET, bytes(data[start:end]))
+        elif atype == self.ATYPE_IPV6:
+            host = socket.inet_ntop(socket.AF_INET6, bytes(data[start:end]))
+        else:
+            try:
+                host = data[start:end].decode("utf-8")
+                # what getaddrinfo does to it, e.g. labels over 63 chars fail
+                host.encode("idna")
+            except UnicodeError:
+                self._log(logging.ERROR, "bad domain: %r", bytes(data[start:end]))
+                self._reply_error(self.REP_HOST_UNREACHABLE)
+                return 0
+        port = self._port_b2i(data[end:end + 2])
+
+        if cmd == self.CMD_UDPA:
+            self._handle_udp_associate(host, port)
+            return end + 2
+        if cmd != self.CMD_CONN:
+            self._log(logging.ERROR, "unsupported cmd: %d", cmd)
+            self._reply_error(self.REP_CMD_UNSUPPORTED)
+            return 0
+
+        self._stage = self.STAGE_CONNECTING
+        self.last_active = self._loop.time()
+        self._log(logging.INFO, "%s:%d", host, port)
+        self.stats.add_destination(host)
+        self._dns_started = self._loop.time()
+        futu = self._resolver.resolve(host, port)
         futu.add_done_callback(self._future_get_addrinfo)
         self._futures.append(futu)
+        return end + 2
 
 
-    def _handle_stream(self, data: bytes):
-        try:
-            self._socket.sendall(data)
-        except BrokenPipeError:
-            log.error("BrokenPipeError")
-            self._transport.write(b"\x05\x01" + self._con_data[2:])
+    def _handle_udp_associate(self, host, port):
+        # DST.ADDR/DST.PORT is where the client will send from, may be zeros
+        self._stage = self.STAGE_UDP
+        self.stats.udp_associations += 1
+        if host in ("0.0.0.0", "::"):
+            host = self._peername[0]
+        local = self._transport.get_extra_info("sockname")
+        self._log(logging.INFO, "udp associate from %s:%d", host, port)
 
+        def factory():
+            return UDPRelayProtocol(self._loop, (host, port), self._resolver, timeout=self.udp_timeout)
+
+        coro = self._loop.create_datagram_endpoint(factory, local_addr=(local[0], 0))
+        futu = asyncio.ensure_future(coro)
+        futu.add_done_callback(self._future_udp_made)
+        self._futures.append(futu)
+
+    def _future_udp_made(self, futu):
+        if futu.cancelled():
+            return
+        if futu.exception():
+            self._log(logging.ERROR, "udp error: %s", futu.exception())
+            self._reply_error(self.REP_FAILURE)
+            return
+        transport, self._udp = futu.result()
+        self._reply(self.REP_SUCCEEDED, transport.get_extra_info("sockname"))
 
     def _future_get_addrinfo(self, futu):
+        self.stats.dns_latency.append(self._loop.time() - self._dns_started)
         try:
             info = futu.result()
         except asyncio.CancelledError:
-            log.warning("future canceled")
+            self._log(logging.WARNING, "future canceled")
+            return
+        except (OSError, ValueError) as e:
+            # ValueError, such as UnicodeError of idna
+            self._log(logging.ERROR, "getaddrinfo error: %s", e)
+            self._reply_error(self.REP_HOST_UNREACHABLE)
             return
-        info = info[0]
-        self._socket = socket.socket(info[0], info[1], info[2])
-        self._socket.setblocking(False)
-        coro = self._loop.sock_connect(self._socket, info[-1])
+        coro = happy_connect(self._loop, info, self.happy_eyeballs_delay)
         futu2 = asyncio.ensure_future(coro)
         futu2.add_done_callback(self._future_sock_connect)
         self._futures.append(futu2)
 
     def _future_sock_connect(self, futu):
-        if self._socket.fileno() == -1:
-            log.warning("error socket")
-            self._transport.write(b"\x05\x01" + self._con_data[2:])
+        if futu.cancelled():
+            return
+        exc = futu.exception()
+        if exc:
+            self._log(logging.ERROR, "connect error: %s", exc)
+            if isinstance(exc, ConnectionRefusedError):
+                self._reply_error(self.REP_REFUSED)
+            elif getattr(exc, "errno", None) == errno.ENETUNREACH:
+                self._reply_error(self.REP_NETWORK_UNREACHABLE)
+            else:
+                self._reply_error(self.REP_HOST_UNREACHABLE)
             return
 
-        try:
-            log.info("%s connected", self._socket.getpeername())
-        except OSError:
-            log.error("connect error")
-            self._transport.write(b"\x05\x01" + self._con_data[2:])
+        self._socket = futu.result()
+
+        self._log(logging.INFO, "%s connected", self._socket.getpeername())
+        def factory():
+            self._upstream_protocol = UpstreamProtocol(self)
+            return self._upstream_protocol
+
+        coro = self._loop.create_connection(factory, sock=self._socket)
+        futu2 = asyncio.ensure_future(coro)
+        futu2.add_done_callback(self._future_upstream_made)
+        self._futures.append(futu2)
+
+    def _future_upstream_made(self, futu):
+        if futu.cancelled():
             return
+        if futu.exception():
+            self._log(logging.ERROR, "upstream error: %s", futu.exception())
+            self._reply_error(self.REP_FAILURE)
 
-        self._loop.add_reader(self._socket, self._recv)
-        self._transport.write(b"\x05\x00" + self._con_data[2:])
+    def _reply(self, rep, sockname=None):
+        "VER REP RSV ATYP BND.ADDR BND.PORT"
+        if sockname and ":" in sockname[0]:
+            addr = b"\x04" + socket.inet_pton(socket.AF_INET6, sockname[0])
+        elif sockname:
+            addr = b"\x01" + socket.inet_pton(socket.AF_INET, sockname[0])
+        else:
+            addr = b"\x01\x00\x00\x00\x00"
+        port = self._port_i2b(sockname[1] if sockname else 0)
+        self._transport.write(bytes((5, rep, 0)) + addr + port)
 
-    def _recv(self):
-        data = self._socket.recv(512)
-        if data:
-            self._transport.write(data)
+    def _reply_error(self, rep):
+        if self._stage == self.STAGE_CONNECTING:
+            self.stats.connect_failures += 1
+        self._reply(rep)
+        self._transport.close()
 
 
     @staticmethod
@@ -131,21 +847,260 @@ class LightProxyProtocol(asyncio.Protocol):
 
     @staticmethod
     def _port_i2b(ii: int):
-        return ii.to_bytes(16, "big")
+        return ii.to_bytes(2, "big")
 
 
-if __name__ == "__main__":
-    import cclog
-    cclog.init()
-    loop = asyncio.get_event_loop()
+class LightProxyServer:
+    """serve LightProxyProtocol on one event loop,
+    kwargs are passed to every protocol,
+    the connections are tracked for timeouts and a graceful shutdown,
+    no more are accepted while `max_connections` are open,
+    pending ones wait in the listen backlog."""
+
+    MAX_CONNECTIONS = 0
+    SWEEP_INTERVAL = 1
+    # like asyncio's servers, back off when accept fails, e.g. out of fds
+    ACCEPT_RETRY_DELAY = 1
+
+    def __init__(self, loop, **kwargs):
+        self._loop = loop
+        self.max_connections = kwargs.pop("max_connections", self.MAX_CONNECTIONS)
+        self._kwargs = kwargs
+        self._stats = kwargs.get("stats")
+        self._sockets = []
+        self._tasks = []
+        self._sweeper = None
+        self._slot = asyncio.Event()
+        self.connections = set()
+        self.closing = False
+
+    def _factory(self):
+        return LightProxyProtocol(self._loop, server=self, **self._kwargs)
+
+    async def start(self, host, port, reuse_port=False):
+        infos = await self._loop.getaddrinfo(host, port, type=socket.SOCK_STREAM, flags=socket.AI_PASSIVE)
+        for info in infos:
+            sock = socket.socket(info[0], info[1], info[2])
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if reuse_port:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            if info[0] == socket.AF_INET6:
+                sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+            sock.bind(info[-1])
+            sock.listen(socket.SOMAXCONN)
+            sock.setblocking(False)
+            self._sockets.append(sock)
+            self._tasks.append(asyncio.ensure_future(self._accept(sock)))
+        self._sweeper = self._loop.call_later(self.SWEEP_INTERVAL, self._sweep)
+
+    async def _accept(self, sock):
+        while True:
+            while self.max_connections and len(self.connections) >= self.max_connections:
+                if self._stats:
+                    self._stats.throttled += 1
+                self._slot.clear()
+                await self._slot.wait()
+            try:
+                conn, _ = await self._loop.sock_accept(sock)
+            except OSError as e:
+                log.error("accept error: %s, retry in %ss", e, self.ACCEPT_RETRY_DELAY)
+                await asyncio.sleep(self.ACCEPT_RETRY_DELAY)
+                continue
+            try:
+                await self._loop.connect_accepted_socket(self._factory, conn)
+            except OSError as e:
+                log.error("accept error: %s", e)
+                conn.close()
+
+    def release(self, conn):
+        self.connections.discard(conn)
+        self._slot.set()
+
+    def _sweep(self):
+        now = self._loop.time()
+        for conn in list(self.connections):
+            conn.check_timeouts(now)
+        self._sweeper = self._loop.call_later(self.SWEEP_INTERVAL, self._sweep)
+
+    async def shutdown(self, grace):
+        "stop accepting, wait `grace` seconds for the connections, then abort the rest"
+        if self.closing:
+            return
+        self.closing = True
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        for sock in self._sockets:
+            sock.close()
+        deadline = self._loop.time() + grace
+        while self.connections and self._loop.time() < deadline:
+            await asyncio.sleep(0.1)
+        if self.connections:
+            log.warning("abort %d connections", len(self.connections))
+        for conn in list(self.connections):
+            conn.close()
+        self._sweeper.cancel()
+
+
+def serve(args, reuse_port=False, index=0):
+    """run a proxy loop until SIGTERM or SIGINT,
+    the stats of worker `index` are on port stats_port + index"""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
     # loop.set_debug(True)
-    coro = loop.create_server(lambda: LightProxyProtocol(loop), '127.0.0.1', 22333)
-    server = loop.run_until_complete(coro)
+    resolver = DNSCache(loop, ttl=args.dns_ttl, negative_ttl=args.dns_negative_ttl,
+                        maxsize=args.dns_cache_size)
+    stats = ProxyStats(resolver)
+    server = LightProxyServer(loop, high_water=args.high_water, low_water=args.low_water,
+                              resolver=resolver, happy_eyeballs_delay=args.happy_eyeballs_delay,
+                              udp_timeout=args.udp_timeout, stats=stats, log_sample=args.log_sample,
+                              handshake_timeout=args.handshake_timeout, connect_timeout=args.connect_timeout,
+                              idle_timeout=args.idle_timeout, stall_timeout=args.stall_timeout,
+                              max_connections=args.max_connections)
+    loop.run_until_complete(server.start(args.host, args.port, reuse_port))
+    if args.stats_port:
+        coro = serve_stats(stats, "127.0.0.1", args.stats_port + index)
+        loop.run_until_complete(coro)
+
+    async def stop():
+        await server.shutdown(args.grace)
+        loop.stop()
+
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, lambda: asyncio.ensure_future(stop()))
     try:
         loop.run_forever()
-    except:
-        pass
     finally:
-        server.close()
-        loop.run_until_complete(server.wait_closed())
-        loop.close()
\ No newline at end of file
+        log.info("stats: %s", stats.snapshot())
+        loop.close()
+
+
+class Prefork:
+    """run `workers` processes of serve() sharing one port by SO_REUSEPORT,
+    so the kernel balances accepts between them.
+    a dead worker is restarted, SIGHUP restarts all workers one by one,
+    SIGTERM/SIGINT shut down all workers gracefully."""
+
+    SIGNALS = {signal.SIGCHLD, signal.SIGTERM, signal.SIGINT, signal.SIGHUP}
+    RESTART_DELAY = 1
+
+    def __init__(self, args):
+        self._args = args
+        self._workers = {}  # pid -> (index, start time)
+        self._retired = set()
+
+    def _spawn(self, index):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                signal.pthread_sigmask(signal.SIG_UNBLOCK, self.SIGNALS)
+                serve(self._args, reuse_port=True, index=index)
+            except BaseException:  # noqa
+                traceback.print_exc()
+                code = 1
+            finally:
+                os._exit(code)
+        self._workers[pid] = (index, time.monotonic())
+        log.info("worker %d started, pid %d", index, pid)
+
+    def _reap(self):
+        "return workers exited unexpectedly"
+        dead = []
+        while self._workers:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                break
+            index, started = self._workers.pop(pid)
+            log.info("worker %d exited, pid %d, status %d", index, pid, status)
+            if pid in self._retired:
+                self._retired.discard(pid)
+            else:
+                dead.append((index, started))
+        return dead
+
+    def run(self):
+        signal.pthread_sigmask(signal.SIG_BLOCK, self.SIGNALS)
+        for i in range(self._args.workers):
+            self._spawn(i)
+
+        while True:
+            sig = signal.sigwait(self.SIGNALS)
+            if sig == signal.SIGCHLD:
+                for index, started in self._reap():
+                    if time.monotonic() - started < self.RESTART_DELAY:
+                        time.sleep(self.RESTART_DELAY)
+                    self._spawn(index)
+            elif sig == signal.SIGHUP:
+                # start the new one before retiring the old one, so no capacity is lost
+                log.info("restart workers")
+                for pid, (index, _) in list(self._workers.items()):
+                    self._spawn(index)
+                    self._retired.add(pid)
+                    os.kill(pid, signal.SIGTERM)
+            else:
+                break
+        self.stop()
+
+    def stop(self):
+        for pid in self._workers:
+            os.kill(pid, signal.SIGTERM)
+        deadline = time.monotonic() + self._args.grace + 1
+        while self._workers:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0 or signal.sigtimedwait({signal.SIGCHLD}, timeout) is None:
+                break
+            self._reap()
+        for pid in self._workers:
+            log.warning("kill worker pid %d", pid)
+            os.kill(pid, signal.SIGKILL)
+        while self._workers:
+            pid, _ = os.wait()
+            self._workers.pop(pid, None)
+
+
+def main(argv=None):
+    import argparse
+    import cclog
+    parser = argparse.ArgumentParser(description="a light socks5 proxy")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=22333)
+    parser.add_argument("--log-level", default="DEBUG")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of worker processes sharing the port by SO_REUSEPORT")
+    parser.add_argument("--grace", type=float, default=10,
+                        help="seconds to wait for connections on shutdown")
+    parser.add_argument("--stats-port", type=int, default=0,
+                        help="serve stats as json on this local http port, worker i uses port + i")
+    parser.add_argument("--log-sample", type=int, default=LightProxyProtocol.LOG_SAMPLE,
+                        help="log the details of one in this many connections")
+    parser.add_argument("--max-connections", type=int, default=LightProxyServer.MAX_CONNECTIONS,
+                        help="stop accepting while this many connections are open, 0 for no limit")
+    parser.add_argument("--handshake-timeout", type=float, default=LightProxyProtocol.HANDSHAKE_TIMEOUT)
+    parser.add_argument("--connect-timeout", type=float, default=LightProxyProtocol.CONNECT_TIMEOUT)
+    parser.add_argument("--idle-timeout", type=float, default=LightProxyProtocol.IDLE_TIMEOUT,
+                        help="close a stream without data in either direction for this long")
+    parser.add_argument("--stall-timeout", type=float, default=LightProxyProtocol.STALL_TIMEOUT,
+                        help="abort a stream whose writes are blocked for this long")
+    parser.add_argument("--dns-ttl", type=float, default=DNSCache.TTL)
+    parser.add_argument("--dns-negative-ttl", type=float, default=DNSCache.NEGATIVE_TTL)
+    parser.add_argument("--dns-cache-size", type=int, default=DNSCache.MAXSIZE)
+    parser.add_argument("--happy-eyeballs-delay", type=float, default=HAPPY_EYEBALLS_DELAY,
+                        help="seconds between connection attempts to the addresses of a host")
+    parser.add_argument("--udp-timeout", type=float, default=UDPRelayProtocol.TIMEOUT,
+                        help="seconds before an idle udp destination is forgotten")
+    parser.add_argument("--high-water", type=int, default=LightProxyProtocol.HIGH_WATER,
+                        help="pause reading the other side when a write buffer is over this")
+    parser.add_argument("--low-water", type=int, default=LightProxyProtocol.LOW_WATER,
+                        help="resume reading the other side when a write buffer is under this")
+    args = parser.parse_args(argv)
+
+    cclog.init(level=getattr(cclog, args.log_level.upper()))
+    if args.workers > 1:
+        Prefork(args).run()
+    else:
+        serve(args)
+
+
+if __name__ == "__main__":
+    main()
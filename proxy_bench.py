@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+CHUNK = b"x" * (256 * 1024)
+
+
+async def echo_handler(reader, writer):
+    "send back whatever is received"
+    while True:
+        data = await reader.read(64 * 1024)
+        if not data:
+            break
+        writer.write(data)
+        await writer.drain()
+    writer.close()
+
+
+async def sink_handler(reader, writer):
+    "read until eof, then reply the byte count as 8 bytes"
+    total = 0
+    while True:
+        data = await reader.read(256 * 1024)
+        if not data:
+            break
+        total += len(data)
+    writer.write(total.to_bytes(8, "big"))
+    await writer.drain()
+    writer.close()
+
+
+async def source_handler(reader, writer):
+    "read the wanted size as 8 bytes, send that many bytes, then close"
+    left = int.from_bytes(await reader.readexactly(8), "big")
+    while left > 0:
+        n = min(left, len(CHUNK))
+        writer.write(CHUNK[:n])
+        await writer.drain()
+        left -= n
+    writer.close()
+
+
+class UDPEcho(asyncio.DatagramProtocol):
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.transport.sendto(data, addr)
+
+
+class UDPCounter(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.received = 0
+        self.event = asyncio.Event()
+
+    def datagram_received(self, data, addr):
+        self.received += 1
+        self.event.set()
+
+
+class Upstream:
+    "local stand-ins of upstream servers, echo/sink/source on port, port + 1, port + 2"
+
+    def __init__(self, port):
+        self.echo = port
+        self.sink = port + 1
+        self.source = port + 2
+        self._servers = []
+        self._udp = None
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        for handler, port in ((echo_handler, self.echo), (sink_handler, self.sink),
+                              (source_handler, self.source)):
+            self._servers.append(await asyncio.start_server(handler, "127.0.0.1", port, backlog=4096))
+        self._udp, _ = await loop.create_datagram_endpoint(UDPEcho, local_addr=("127.0.0.1", self.echo))
+
+    async def close(self):
+        self._udp.close()
+        for server in self._servers:
+            server.close()
+            await server.wait_closed()
+
+
+async def socks5_connect(proxy_host, proxy_port, host, port):
+    reader, writer = await asyncio.open_connection(proxy_host, proxy_port)
+    writer.write(b"\x05\x01\x00")
+    await reader.readexactly(2)
+    hb = host.encode("utf-8")
+    writer.write(b"\x05\x01\x00\x03" + bytes([len(hb)]) + hb + port.to_bytes(2, "big"))
+    rep = await reader.readexactly(4)
+    if rep[1] != 0:
+        raise ConnectionError("socks5 reply {}".format(rep[1]))
+    # skip BND.ADDR and BND.PORT
+    await reader.readexactly({1: 4, 4: 16}[rep[3]] + 2)
+    return reader, writer
+
+
+async def socks5_udp_associate(proxy_host, proxy_port):
+    "return the control connection and the relay address"
+    reader, writer = await asyncio.open_connection(proxy_host, proxy_port)
+    writer.write(b"\x05\x01\x00" + b"\x05\x03\x00\x01\x00\x00\x00\x00\x00\x00")
+    await reader.readexactly(2)
+    rep = await reader.readexactly(4)
+    if rep[1] != 0:
+        raise ConnectionError("socks5 reply {}".format(rep[1]))
+    addr = await reader.readexactly(4)
+    port = int.from_bytes(await reader.readexactly(2), "big")
+    return writer, (socket.inet_ntoa(addr), port)
+
+
+async def open_stream(proxy_port, port):
+    "connect through the proxy, or directly when proxy_port is None"
+    if proxy_port is None:
+        return await asyncio.open_connection("127.0.0.1", port)
+    return await socks5_connect("127.0.0.1", proxy_port, "127.0.0.1", port)
+
+
+async def download(proxy_port, upstream, size):
+    reader, writer = await open_stream(proxy_port, upstream.source)
+    writer.write(size.to_bytes(8, "big"))
+    total = 0
+    while True:
+        data = await reader.read(256 * 1024)
+        if not data:
+            break
+        total += len(data)
+    writer.close()
+    assert total == size, (total, size)
+    return total
+
+
+async def upload(proxy_port, upstream, size):
+    reader, writer = await open_stream(proxy_port, upstream.sink)
+    left = size
+    while left > 0:
+        n = min(left, len(CHUNK))
+        writer.write(CHUNK[:n])
+        await writer.drain()
+        left -= n
+    writer.write_eof()
+    total = int.from_bytes(await reader.readexactly(8), "big")
+    writer.close()
+    assert total == size, (total, size)
+    return total
+
+
+def percentiles(samples):
+    if not samples:
+        return {"p50": None, "p99": None}
+    ss = sorted(samples)
+    return {
+        "p50": ss[len(ss) // 2] * 1000,
+        "p99": ss[min(len(ss) - 1, len(ss) * 99 // 100)] * 1000,
+    }
+
+
+async def run_clients(clients, total, job):
+    "run `total` jobs on `clients` concurrent clients, return the seconds cost"
+    counter = iter(range(total))
+
+    async def client():
+        for i in counter:
+            await job(i)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(clients)))
+    return time.perf_counter() - start
+
+
+async def bench_connect(proxy_port, upstream, clients, total):
+    "short connections: handshake, one small echo, close"
+    handshakes = []
+
+    async def job(i):
+        start = time.perf_counter()
+        reader, writer = await open_stream(proxy_port, upstream.echo)
+        handshakes.append(time.perf_counter() - start)
+        writer.write(b"ping")
+        await reader.readexactly(4)
+        writer.close()
+
+    cost = await run_clients(clients, total, job)
+    result = {"connections_per_sec": total / cost}
+    result.update({"handshake_ms_" + k: v for k, v in percentiles(handshakes).items()})
+    return result
+
+
+async def bench_transfer(proxy_port, upstream, clients, total, size, func):
+    "`total` transfers of `size` bytes each"
+    async def job(i):
+        await func(proxy_port, upstream, size)
+
+    cost = await run_clients(clients, total, job)
+    return {
+        "transfers_per_sec": total / cost,
+        "mb_per_sec": total * size / cost / 1024 / 1024,
+    }
+
+
+async def bench_udp(proxy_port, upstream, count, size=64, window=64):
+    "send `count` datagrams through the relay to an echo server, keep `window` in flight"
+    loop = asyncio.get_running_loop()
+    writer, relay = await socks5_udp_associate("127.0.0.1", proxy_port)
+    transport, counter = await loop.create_datagram_endpoint(UDPCounter, local_addr=("127.0.0.1", 0))
+    header = b"\x00\x00\x00\x01" + socket.inet_aton("127.0.0.1") + upstream.echo.to_bytes(2, "big")
+    packet = header + b"x" * size
+    sent = 0
+    start = time.perf_counter()
+    while counter.received < count:
+        while sent < count and sent - counter.received < window:
+            transport.sendto(packet, relay)
+            sent += 1
+        counter.event.clear()
+        try:
+            await asyncio.wait_for(counter.event.wait(), 1)
+        except asyncio.TimeoutError:
+            # lost, refill the window
+            sent = counter.received
+    cost = time.perf_counter() - start
+    transport.close()
+    writer.close()
+    return {"packets_per_sec": count / cost}
+
+
+async def run(args):
+    upstream = Upstream(args.upstream_port)
+    await upstream.start()
+    results = {}
+    try:
+        targets = [("proxy", args.proxy_port)]
+        if args.direct:
+            targets.insert(0, ("direct", None))
+        for name, port in targets:
+            res = results[name] = {}
+            res["connect"] = await bench_connect(port, upstream, args.clients, args.connections)
+            res["small_download"] = await bench_transfer(
+                port, upstream, args.clients, args.connections, args.small_size, download)
+            res["large_download"] = await bench_transfer(
+                port, upstream, args.large_clients, args.large_count, args.large_size, download)
+            res["large_upload"] = await bench_transfer(
+                port, upstream, args.large_clients, args.large_count, args.large_size, upload)
+            if port is not None and args.udp_packets:
+                res["udp"] = await bench_udp(port, upstream, args.udp_packets)
+    finally:
+        await upstream.close()
+    return results
+
+
+def start_proxy(port, workers=1):
+    cmd = [sys.executable, os.path.join(HERE, "proxy.py"), "--port", str(port),
+           "--log-level", "WARNING", "--workers", str(workers)]
+    proc = subprocess.Popen(cmd)
+    time.sleep(0.5)
+    return proc
+
+
+def revision():
+    try:
+        out = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=HERE,
+                                      stderr=subprocess.DEVNULL)
+        return out.decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def flatten(results, prefix=""):
+    for k, v in results.items():
+        if isinstance(v, dict):
+            yield from flatten(v, prefix + k + ".")
+        else:
+            yield prefix + k, v
+
+
+def report(results, baseline=None):
+    base = dict(flatten(baseline["results"])) if baseline else {}
+    for key, value in flatten(results):
+        if value is None:
+            continue
+        line = "{:<44} {:>14.2f}".format(key, value)
+        old = base.get(key)
+        if old:
+            line += "  {:>+8.1f}%".format((value - old) / old * 100)
+        print(line)
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="benchmark of proxy.py")
+    parser.add_argument("--proxy-port", type=int, default=22334)
+    parser.add_argument("--upstream-port", type=int, default=22335,
+                        help="echo/sink/source upstreams on this port and the next two")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes of the proxy")
+    parser.add_argument("--clients", type=int, default=50, help="concurrent clients of small jobs")
+    parser.add_argument("--connections", type=int, default=5000, help="short connections to make")
+    parser.add_argument("--small-size", type=int, default=4096)
+    parser.add_argument("--large-clients", type=int, default=4)
+    parser.add_argument("--large-count", type=int, default=8)
+    parser.add_argument("--large-size", type=int, default=128 * 1024 * 1024)
+    parser.add_argument("--udp-packets", type=int, default=100000)
+    parser.add_argument("--direct", action="store_true", help="also measure without the proxy")
+    parser.add_argument("--output", help="save the results into this json file")
+    parser.add_argument("--compare", help="json file of an earlier run to compare with")
+    args = parser.parse_args(argv)
+
+    proc = start_proxy(args.proxy_port, args.workers)
+    try:
+        results = asyncio.run(run(args))
+    finally:
+        proc.terminate()
+        proc.wait()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)
+    report(results, baseline)
+    if args.output:
+        params = {k: v for k, v in vars(args).items() if k not in ("output", "compare")}
+        with open(args.output, "w") as fp:
+            json.dump({"revision": revision(), "time": time.time(), "params": params,
+                       "results": results}, fp, indent=2)
+
+
+if __name__ == "__main__":
+    main()